@@ -4,6 +4,7 @@ Created on Feb 26, 2024
 @author: immanueltrummer
 '''
 import math
+import numpy
 
 
 def optimal_block_size(s1, s2, s3, t, p, estimate):
@@ -25,4 +26,27 @@ def optimal_block_size(s1, s2, s3, t, p, estimate):
         (math.sqrt(s1*s1*s2*s2+s1*s2*s3*estimate*(t-p))-s1*s2)/
         (s1*s3*estimate))
     b2 = math.floor(((t-p)-b1*s1)/(s2+b1*s3*estimate))
-    return b1, b2
\ No newline at end of file
+    return b1, b2
+
+
+def optimal_block_sizes(s1, s2, s3, t, p, estimate):
+    """ Calculates optimal block sizes for many parameter settings at once.
+    
+    Args:
+        s1: array of tuple sizes in first table.
+        s2: array of tuple sizes in second table.
+        s3: array of join result tuple sizes.
+        t: array of thresholds on tokens per LLM invocation.
+        p: array of static prompt part sizes.
+        estimate: array of selectivity estimates.
+    
+    Returns:
+        (array of block sizes for first table, array for second table)
+    """
+    estimate = numpy.maximum(estimate, 0.0000001)
+    b1 = numpy.floor(
+        (numpy.sqrt(s1*s1*s2*s2+s1*s2*s3*estimate*(t-p))-s1*s2)/
+        (s1*s3*estimate)).astype(numpy.int64)
+    b2 = numpy.floor(
+        ((t-p)-b1*s1)/(s2+b1*s3*estimate)).astype(numpy.int64)
+    return b1, b2
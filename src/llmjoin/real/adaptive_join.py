@@ -3,34 +3,234 @@ Created on Feb 24, 2024
 
 @author: immanueltrummer
 '''
-from llmjoin.real.block_join import block_join
+import contextlib
 
+from llmjoin.common.tuning import optimal_block_size
+from llmjoin.real.block_join import complete_prompt
+from llmjoin.real.block_join import create_prompt
+from llmjoin.real.block_join import data_size
+from llmjoin.real.block_join import find_indexes
+from llmjoin.real.block_join import prompt_size
+from llmjoin.real.block_join import t
+from llmjoin.real.block_join import token_size
+from llmjoin.real.block_join import tuple_size
+from llmjoin.real.cache import fingerprint
+from llmjoin.real.checkpoint import Checkpoint
+from llmjoin.real.scheduler import ordered_map
+from llmjoin.real.streaming import collect
 
-def adaptive_join(client, df1, df2, predicate, model, estimate=0.001):
+
+def split_blocks(
+        block_1, block_2, s1, s2, s3, p, estimate, overflowed=False):
+    """ Split pair of blocks into smaller pairs, based on estimate.
+    
+    Args:
+        block_1: block from first table.
+        block_2: block from second table.
+        s1: average tuple size in first table.
+        s2: average tuple size in second table.
+        s3: size of join result tuples.
+        p: size of static prompt parts.
+        estimate: selectivity estimate for this pair of blocks.
+        overflowed: whether the blocks overflowed (split at least in half).
+    
+    Returns:
+        list of block pairs covering all tuple pairs of input blocks.
+    """
+    b1, b2 = optimal_block_size(s1, s2, s3, t, p, estimate)
+    b1 = max(1, min(b1, len(block_1)))
+    b2 = max(1, min(b2, len(block_2)))
+    if overflowed and b1 == len(block_1) and b2 == len(block_2):
+        b1 = max(1, b1 // 2)
+        b2 = max(1, b2 // 2)
+    
+    pairs = []
+    for start_1 in range(0, len(block_1), b1):
+        for start_2 in range(0, len(block_2), b2):
+            sub_block_1 = block_1[start_1:start_1+b1]
+            sub_block_2 = block_2[start_2:start_2+b2]
+            pairs.append((sub_block_1, sub_block_2, estimate))
+    return pairs
+
+
+def join_blocks(
+        client, block_1, block_2, predicate, model, 
+        limiter=None, cache=None):
+    """ Joins two blocks, keeping complete results of truncated answers.
+    
+    After an overflow, index pairs before the truncation point are kept.
+    If pairs are listed in ascending order of the first index, entries
+    of the first block before the last listed one count as covered and
+    their results are returned (other results are discarded since the
+    corresponding entries are joined again).
+    
+    Args:
+        client: OpenAI client or backend.
+        block_1: list of entries from first table.
+        block_2: list of entries from second table.
+        predicate: join predicate as text.
+        model: name of OpenAI model to use.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+    
+    Returns:
+        Statistics, join result. After overflows, statistics contain the
+        number of covered entries of the first block and of listed pairs.
+    """
+    prompt = create_prompt(block_1, block_2, predicate)
+    prompt_tokens = prompt_size(block_1, block_2, predicate)
+    stats, answer = complete_prompt(
+        client, prompt, model, limiter, cache, prompt_tokens)
+    stats['data_tokens'] = data_size(block_1, block_2)
+    pairs = find_indexes(
+        answer, len(block_1), len(block_2), complete=not stats['overflow'])
+    
+    covered = len(block_1)
+    if stats['overflow']:
+        xs = [x for x, _ in pairs]
+        covered = xs[-1] if xs and xs == sorted(xs) else 0
+        stats['covered_rows'] = covered
+        stats['listed_pairs'] = len(pairs)
+    
+    results = [
+        {'tuple1':block_1[x], 'tuple2':block_2[y]} 
+        for x, y in pairs if x < covered]
+    return stats, results
+
+
+def adaptive_join_stream(
+        client, df1, df2, predicate, model, estimate=0.001, 
+        parallelism=1, limiter=None, cache=None, checkpoint_path=None, 
+        growth=2):
     """ Perform block join with adaptive selectivity estimates.
     
+    Block sizes are initially chosen based on the given estimate. Block
+    pairs that overflow are split into smaller pairs (results of other
+    block pairs are kept). Sizes of the smaller pairs are chosen based on
+    the selectivity observed in the truncated answer for that pair. The
+    results for entries covered by truncated answers are produced right
+    away and those entries are not joined again (see join_blocks). If a
+    pair of single entries overflows, its statistics are marked as
+    failed and the join stops.
+    
     Args:
-        client: OpenAI client.
+        client: OpenAI client or backend.
         df1: first input table.
         df2: second input table.
         predicate: join predicate as text.
         model: name of OpenAI model.
         estimate: initial selectivity estimate.
+        parallelism: maximal number of concurrent LLM invocations.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        checkpoint_path: optional path to log of joined block pairs.
+        growth: factor by which estimates are increased after overflows.
     
     Returns:
-        performance statistics, result
+        A generator over (statistics, join result) per block pair.
     """
-    overflow = True
+    s1 = tuple_size(df1)
+    s2 = tuple_size(df2)
+    s3 = 4
+    p = token_size(create_prompt([], [], predicate))
+    tuples_1 = list(df1['text'])
+    tuples_2 = list(df2['text'])
+    pending = split_blocks(
+        tuples_1, tuples_2, s1, s2, s3, p, estimate)
+    
+    checkpoint = None
+    if checkpoint_path is not None:
+        join_id = {
+            'table_1':fingerprint(tuples_1), 
+            'table_2':fingerprint(tuples_2), 
+            'predicate':predicate, 'model':model, 't':t, 
+            'operator':'adaptive_join'}
+        checkpoint = Checkpoint(checkpoint_path, join_id)
     
-    all_stats = []
-    while overflow:
-        stats, result = block_join(
-            client, df1, df2, predicate, 
-            model, estimate)
+    def join_pair(pair):
+        """ Joins one pair of blocks.
+        
+        Args:
+            pair: tuple containing two blocks and selectivity estimate.
+        
+        Returns:
+            Statistics, join result.
+        """
+        block_1, block_2, _ = pair
+        if checkpoint is not None:
+            key_1 = fingerprint(block_1)
+            key_2 = fingerprint(block_2)
+            completed = checkpoint.lookup(key_1, key_2)
+            if completed is not None:
+                stats, results = completed
+                return stats | {'resumed':True}, results
         
-        all_stats += stats
-        overflow = any([s['overflow'] for s in stats])
-        estimate *= 4
-        print(f'*** New estimate: {estimate} ***')
+        stats, results = join_blocks(
+            client, block_1, block_2, 
+            predicate, model, limiter, cache)
+        if checkpoint is not None:
+            checkpoint.record(key_1, key_2, stats, results)
+            stats = stats | {'resumed':False}
+        return stats, results
     
-    return all_stats, result
\ No newline at end of file
+    try:
+        while pending:
+            print(f'*** Joining {len(pending)} block pairs ***')
+            overflowed = []
+            with contextlib.closing(
+                ordered_map(join_pair, pending, parallelism)) as pair_results:
+                for pair, (stat, result) in zip(pending, pair_results):
+                    if not stat['overflow']:
+                        yield stat, result
+                        continue
+                    
+                    block_1, block_2, pair_estimate = pair
+                    nr_pairs = len(block_1) * len(block_2)
+                    if nr_pairs == 1:
+                        print('Cannot split blocks further!')
+                        yield stat | {'failed':True}, result
+                        return
+                    
+                    yield stat, result
+                    observed = stat.get('listed_pairs', 0) / nr_pairs
+                    new_estimate = growth * max(observed, pair_estimate)
+                    print(
+                        f'*** Overflow for {len(block_1)}x{len(block_2)} '
+                        f'blocks - new estimate: {new_estimate} ***')
+                    open_1 = block_1[stat.get('covered_rows', 0):]
+                    overflowed += split_blocks(
+                        open_1, block_2, s1, s2, s3, p, new_estimate, 
+                        overflowed=True)
+            
+            pending = overflowed
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+def adaptive_join(
+        client, df1, df2, predicate, model, estimate=0.001, 
+        parallelism=1, limiter=None, cache=None, checkpoint_path=None, 
+        growth=2):
+    """ Perform block join with adaptive selectivity estimates.
+    
+    Args:
+        client: OpenAI client or backend.
+        df1: first input table.
+        df2: second input table.
+        predicate: join predicate as text.
+        model: name of OpenAI model.
+        estimate: initial selectivity estimate.
+        parallelism: maximal number of concurrent LLM invocations.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        checkpoint_path: optional path to log of joined block pairs.
+        growth: factor by which estimates are increased after overflows.
+    
+    Returns:
+        performance statistics, result
+    """
+    return collect(adaptive_join_stream(
+        client, df1, df2, predicate, model, estimate=estimate,
+        parallelism=parallelism, limiter=limiter, cache=cache,
+        checkpoint_path=checkpoint_path, growth=growth))
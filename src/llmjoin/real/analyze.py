@@ -45,6 +45,19 @@ def analyze_results(reference, results):
     print(f'F1 Score: \t{f1_score}')
 
 
+def has_values(stats, column):
+    """ Checks whether statistics contain values in given column.
+    
+    Args:
+        stats: performance statistics.
+        column: name of statistics column.
+    
+    Returns:
+        True iff the column exists and is not empty.
+    """
+    return column in stats.columns and stats[column].notna().any()
+
+
 def analyze_stats(stats):
     """ Print aggregate performance statistics.
     
@@ -56,8 +69,8 @@ def analyze_stats(stats):
     tokens_written = stats['tokens_written'].sum()
     gpt4_USD = tokens_read * 0.03/1000 + tokens_written * 0.06/1000
     text3_USD = (tokens_read + tokens_written) * 0.02/1000000
-    if 'overflow' in stats.columns:
-        nr_prompts = len(stats[stats['overflow'] == False])
+    if has_values(stats, 'overflow'):
+        nr_prompts = len(stats[stats['overflow'] != True])
     else:
         nr_prompts = len(stats)
     
@@ -67,6 +80,54 @@ def analyze_stats(stats):
     print(f'GPT-4 $:       \t{gpt4_USD}')
     print(f'Text-3 $:       \t{text3_USD}')
     print(f'#Prompts:      \t:{nr_prompts}')
+    if has_values(stats, 'cache_hits'):
+        cache_hits = stats['cache_hits'].sum()
+        cache_misses = stats['cache_misses'].sum()
+        print(f'Cache hits:    \t{cache_hits}')
+        print(f'Cache misses:  \t{cache_misses}')
+    if has_values(stats, 'cached_tokens'):
+        # Providers bill prompt tokens read from their caches at half price
+        cached_tokens = stats['cached_tokens'].sum()
+        cached_share = cached_tokens / tokens_read if tokens_read else 0
+        saved_USD = cached_tokens * 0.5 * 0.03/1000
+        print(f'Cached tokens: \t{cached_tokens}')
+        print(f'Cached share:  \t{cached_share}')
+        print(f'Cache saving $:\t{saved_USD}')
+    if has_values(stats, 'recoveries'):
+        invocations = stats['invocations'].fillna(1).sum()
+        recoveries = stats['recoveries'].sum()
+        print(f'Invocations:   \t{invocations}')
+        print(f'Recoveries:    \t{recoveries}')
+    if has_values(stats, 'continuations'):
+        continuations = stats['continuations'].sum()
+        overhead = stats['continuation_tokens_read'].sum()
+        print(f'Continuations: \t{continuations}')
+        print(f'Cont. tokens:  \t{overhead}')
+    if has_values(stats, 'phase'):
+        sample_stats = stats[stats['phase'] == 'sample']
+        sample_read = sample_stats['tokens_read'].sum()
+        sample_written = sample_stats['tokens_written'].sum()
+        print(f'Sample prompts:\t{len(sample_stats)}')
+        print(f'Sample tokens: \t{sample_read + sample_written}')
+
+
+def analyze_estimate(reference, stats):
+    """ Print accuracy of sampled selectivity estimate.
+    
+    Args:
+        reference: data frame with reference results.
+        stats: performance statistics.
+    """
+    if not has_values(stats, 'sample_estimate'):
+        return
+    
+    selectivity = reference['joins'].mean()
+    estimate = stats['sample_estimate'].dropna().iloc[0]
+    bound = stats['sample_bound'].dropna().iloc[0]
+    print(f'Selectivity:   \t{selectivity}')
+    print(f'Sample estimate:\t{estimate}')
+    print(f'Sample bound:  \t{bound}')
+    print(f'Bound holds:   \t{bound >= selectivity}')
 
 
 if __name__ == '__main__':
@@ -82,4 +143,5 @@ if __name__ == '__main__':
     stats = pandas.read_csv(args.statspath)
     
     analyze_results(reference, results)
-    analyze_stats(stats)
\ No newline at end of file
+    analyze_stats(stats)
+    analyze_estimate(reference, stats)
\ No newline at end of file
@@ -4,6 +4,7 @@ Created on Feb 27, 2024
 @author: immanueltrummer
 '''
 from argparse import ArgumentParser
+from llmjoin.real.analyze import analyze_estimate
 from llmjoin.real.analyze import analyze_stats
 from llmjoin.real.analyze import analyze_results
 from pandas import read_csv
@@ -18,7 +19,8 @@ if __name__ == '__main__':
 
     for op_name in [
         'tuple_join', 'block_join', 
-        'adaptive_join', 'embedding_join']:
+        'adaptive_join', 'embedding_join', 'hybrid_join', 
+        'planned_join']:
         for scenario, ref_name in [
             ('inconsistency', 'inconsistencies.csv'),
             ('inconsistency50names', 'inconsistencies50names.csv'),
@@ -48,4 +50,5 @@ if __name__ == '__main__':
             stats = read_csv(str(stats_path))
             
             analyze_results(reference, results)
-            analyze_stats(stats)
\ No newline at end of file
+            analyze_stats(stats)
+            analyze_estimate(reference, stats)
\ No newline at end of file
@@ -0,0 +1,133 @@
+'''
+Created on Oct 17, 2026
+
+@author: immanueltrummer
+'''
+
+
+def cached_tokens(usage):
+    """ Extracts number of prompt tokens read from the prompt cache.
+    
+    Args:
+        usage: token usage reported by the OpenAI API.
+    
+    Returns:
+        number of cached prompt tokens (zero if not reported).
+    """
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None)
+    return 0 if cached is None else cached
+
+
+class OpenAIBackend():
+    """ Language models accessed via the OpenAI API.
+    
+    Backends offer completions and embeddings to join operators. Other
+    backends (e.g., MockBackend) implement the same methods.
+    """
+    
+    def __init__(self, client):
+        """ Initializes backend.
+        
+        Args:
+            client: OpenAI client.
+        """
+        self.client = client
+    
+    def complete(self, prompt, model, max_tokens, stop=None, on_chunk=None):
+        """ Generates answer to prompt (with temperature zero).
+        
+        Args:
+            prompt: prompt text (sent as user message).
+            model: name of model to use.
+            max_tokens: maximal number of tokens to generate.
+            stop: optional list of stop sequences.
+            on_chunk: optional function called on each generated part of
+                the answer (the answer is streamed if given).
+        
+        Returns:
+            dictionary with answer, finish_reason, tokens_read,
+            tokens_written, and cached_tokens (prompt tokens read from
+            the provider's prompt cache).
+        """
+        messages = [{'role':'user', 'content':prompt}]
+        kwargs = {} if stop is None else {'stop':stop}
+        if on_chunk is not None:
+            return self._stream(messages, model, max_tokens, on_chunk, kwargs)
+        
+        response = self.client.chat.completions.create(
+            messages=messages, model=model,
+            max_tokens=max_tokens, temperature=0, **kwargs)
+        return {
+            'answer':response.choices[0].message.content,
+            'finish_reason':response.choices[0].finish_reason,
+            'tokens_read':response.usage.prompt_tokens,
+            'tokens_written':response.usage.completion_tokens,
+            'cached_tokens':cached_tokens(response.usage)}
+    
+    def _stream(self, messages, model, max_tokens, on_chunk, kwargs):
+        """ Generates answer while streaming its parts.
+        
+        Args:
+            messages: messages of chat conversation.
+            model: name of model to use.
+            max_tokens: maximal number of tokens to generate.
+            on_chunk: function called on each generated part of answer.
+            kwargs: further arguments for completion.
+        
+        Returns:
+            dictionary with answer, finish_reason, tokens_read,
+            tokens_written, and cached_tokens.
+        """
+        stream = self.client.chat.completions.create(
+            messages=messages, model=model,
+            max_tokens=max_tokens, temperature=0, stream=True,
+            stream_options={'include_usage':True}, **kwargs)
+        parts = []
+        finish_reason = None
+        usage = None
+        for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            for choice in chunk.choices:
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                    on_chunk(choice.delta.content)
+                if choice.finish_reason is not None:
+                    finish_reason = choice.finish_reason
+        
+        return {
+            'answer':''.join(parts),
+            'finish_reason':finish_reason,
+            'tokens_read':usage.prompt_tokens,
+            'tokens_written':usage.completion_tokens,
+            'cached_tokens':cached_tokens(usage)}
+    
+    def embed(self, texts, model):
+        """ Calculates embedding vectors for texts.
+        
+        Args:
+            texts: list of texts to embed.
+            model: name of embedding model.
+        
+        Returns:
+            list of embedding vectors, number of tokens read.
+        """
+        response = self.client.embeddings.create(input=texts, model=model)
+        embeddings = [data.embedding for data in response.data]
+        return embeddings, response.usage.prompt_tokens
+
+
+def get_backend(client):
+    """ Returns backend for accessing language models.
+    
+    Args:
+        client: OpenAI client or backend.
+    
+    Returns:
+        the backend itself or a backend wrapping the OpenAI client.
+    """
+    if hasattr(client, 'complete'):
+        return client
+    else:
+        return OpenAIBackend(client)
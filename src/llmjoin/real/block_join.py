@@ -3,13 +3,25 @@ Created on Feb 24, 2024
 
 @author: immanueltrummer
 '''
-import tiktoken
+import contextlib
+import functools
 import time
 
 from llmjoin.common.tuning import optimal_block_size
+from llmjoin.real.backend import get_backend
+from llmjoin.real.cache import completion_key
+from llmjoin.real.cache import fingerprint
+from llmjoin.real.checkpoint import Checkpoint
+from llmjoin.real.sampling import region_bounds
+from llmjoin.real.sampling import sample_blocks
+from llmjoin.real.sampling import upper_bound
+from llmjoin.real.scheduler import ordered_map
+from llmjoin.real.streaming import collect
+from llmjoin.real.tokens import get_counter
 
 
-encoder = tiktoken.encoding_for_model('gpt-4')
+counter = get_counter('gpt-4')
+encoder = counter.encoder
 #t = 4096
 # Prior
 t = 2000
@@ -27,7 +39,7 @@ def token_size(text):
     Returns:
         Number of tokens used by GPT-4 tokenizer.
     """
-    return len(encoder.encode(text))
+    return counter.count(text)
 
 
 def tuple_size(df):
@@ -39,37 +51,177 @@ def tuple_size(df):
     Returns:
         Average tuple size in tokens.
     """
-    return df.apply(lambda r:token_size(r['text']), axis=1).mean()
+    sizes = counter.count_batch(list(df['text']))
+    return sum(sizes) / len(sizes)
 
 
-def create_prompt(block_1, block_2, predicate):
+def data_size(block_1, block_2):
+    """ Returns token size of all entries in two blocks.
+    
+    Args:
+        block_1: block from first table.
+        block_2: block from second table.
+    
+    Returns:
+        Sum of token sizes of entries (excluding prompt template).
+    """
+    return sum(counter.count_batch(block_1 + block_2))
+
+
+def index_label(idx, encoding='verbose'):
+    """ Returns label of entry in prompt.
+    
+    Args:
+        idx: index of entry (starting from one).
+        encoding: prompt encoding (compact encodings use base 36).
+    
+    Returns:
+        label as text.
+    """
+    if encoding == 'verbose':
+        return str(idx)
+    
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    label = ''
+    while idx:
+        idx, digit = divmod(idx, 36)
+        label = digits[digit] + label
+    return label
+
+
+def prompt_size(block_1, block_2, predicate, after=None, encoding='verbose'):
+    """ Calculates token size of prompt from token sizes of entries.
+    
+    The size is the sum of the sizes of the prompt template, entries,
+    and their indexes (plus one token per line break). This avoids
+    encoding each prompt as a whole.
+    
+    Args:
+        block_1: block from first table.
+        block_2: block from second table.
+        predicate: join predicate as text.
+        after: index pair after which to continue (see create_prompt).
+        encoding: prompt encoding (see create_prompt).
+    
+    Returns:
+        Number of tokens (approximating exact size of encoded prompt).
+    """
+    p = token_size(create_prompt([], [], predicate, after, encoding))
+    nr_index_tokens = sum(
+        token_size(f'{index_label(idx, encoding)}:') + 1 
+        for block in [block_1, block_2]
+        for idx in range(1, len(block)+1))
+    return p + data_size(block_1, block_2) + nr_index_tokens
+
+
+def create_prompt(
+        block_1, block_2, predicate, after=None, encoding='verbose', 
+        prefix=None):
     """ Create prompt to join two blocks using given predicate.
     
+    Besides the original ("verbose") encoding, two encodings with fewer
+    tokens are supported: "compact" uses short instructions and base 36
+    labels, "grouped" additionally groups answer pairs by first index.
+    
+    If a prefix collection is specified, the prompt is structured to
+    share long prefixes with prompts for the same block of that
+    collection (enabling prompt caching by providers): static
+    instructions come first, followed by the prefix collection, and
+    instructions for continuations are placed after both collections.
+    
     Args:
         block_1: block from first table.
         block_2: block from second table.
         predicate: join predicate as text.
+        after: optional index pair (starting from zero) - if given, only
+            pairs following this one in ascending order are requested.
+        encoding: prompt encoding ("verbose", "compact", or "grouped").
+        prefix: collection (1 or 2) to list first for prefix reuse or
+            None for the original structure.
     
     Returns:
         a prompt for joining two blocks.
     """
-    parts = []
-    parts += [
+    if encoding != 'verbose':
+        return create_compact_prompt(
+            block_1, block_2, predicate, after, encoding, prefix)
+    
+    instructions = [
         ('Find indexes x,y where x is the number of an entry in collection 1 '
          f'and y the number of an entry in collection 2 such that {predicate} '
          '(make sure to catch all pairs!)!')]
-    parts += ['Separate index pairs by semicolons.']
-    parts += ['Write "Finished" after the last pair!']
-    parts += ['Text Collection 1:']
+    continuation = []
+    if after is not None:
+        x, y = after[0] + 1, after[1] + 1
+        continuation += [
+            (f'Pairs up to {x},{y} were listed before. List only the '
+             f'remaining pairs, in ascending order, starting after {x},{y}!')]
+    format_instructions = [
+        'Separate index pairs by semicolons.',
+        'Write "Finished" after the last pair!']
+    collection_1 = ['Text Collection 1:']
     for idx, text in enumerate(block_1, 1):
-        parts += [f'{idx}: {text}']
-    parts += ['Text Collection 2:']
+        collection_1 += [f'{idx}: {text}']
+    collection_2 = ['Text Collection 2:']
     for idx, text in enumerate(block_2, 1):
-        parts += [f'{idx}: {text}']
+        collection_2 += [f'{idx}: {text}']
+    
+    if prefix is None:
+        parts = instructions + continuation + format_instructions + \
+            collection_1 + collection_2
+    else:
+        collections = collection_1 + collection_2 if prefix == 1 \
+            else collection_2 + collection_1
+        parts = instructions + format_instructions + \
+            collections + continuation
     parts += ['Index pairs:']
     return '\n'.join(parts)
 
 
+def create_compact_prompt(
+        block_1, block_2, predicate, after, encoding, prefix=None):
+    """ Create prompt with compact instructions and entry labels.
+    
+    Args:
+        block_1: block from first table.
+        block_2: block from second table.
+        predicate: join predicate as text.
+        after: optional index pair to continue after (see create_prompt).
+        encoding: prompt encoding ("compact" or "grouped").
+        prefix: collection to list first (see create_prompt).
+    
+    Returns:
+        a prompt for joining two blocks.
+    """
+    instructions = [f'Find all pairs x,y (x in A, y in B) where {predicate}!']
+    if encoding == 'grouped':
+        instructions += [
+            'Answer "x:y,y,...;x:y,...;" (group by x), then "Finished".']
+    else:
+        instructions += ['Answer "x,y;x,y;...", then "Finished".']
+    continuation = []
+    if after is not None:
+        x = index_label(after[0] + 1, encoding)
+        y = index_label(after[1] + 1, encoding)
+        continuation += [
+            f'List only pairs after {x},{y}, in ascending order!']
+    collection_1 = ['A:']
+    for idx, text in enumerate(block_1, 1):
+        collection_1 += [f'{index_label(idx, encoding)}: {text}']
+    collection_2 = ['B:']
+    for idx, text in enumerate(block_2, 1):
+        collection_2 += [f'{index_label(idx, encoding)}: {text}']
+    
+    if prefix is None:
+        parts = instructions + continuation + collection_1 + collection_2
+    else:
+        collections = collection_1 + collection_2 if prefix == 1 \
+            else collection_2 + collection_1
+        parts = instructions + collections + continuation
+    parts += ['Pairs:']
+    return '\n'.join(parts)
+
+
 def partition(df, block_size):
     """ Partitions data into equal-sized blocks.
     
@@ -89,145 +241,1017 @@ def partition(df, block_size):
     return blocks
 
 
-def process_answer(answer, block_1, block_2):
+def pack_rows(costs, budget):
+    """ Divides consecutive rows into groups with bounded total cost.
+    
+    Args:
+        costs: cost of each row.
+        budget: maximal total cost per group (unless group has one row).
+    
+    Returns:
+        list of groups, each represented as (start index, end index).
+    """
+    groups = []
+    start = 0
+    total_cost = 0
+    for idx, cost in enumerate(costs):
+        if idx > start and total_cost + cost > budget:
+            groups.append((start, idx))
+            start = idx
+            total_cost = 0
+        total_cost += cost
+    
+    if start < len(costs):
+        groups.append((start, len(costs)))
+    return groups
+
+
+def token_partition(
+        df1, df2, s3, p, estimate, row_estimates=None, encoding='verbose'):
+    """ Partitions both tables into blocks according to tuple token sizes.
+    
+    Blocks of the first table are packed such that their size (including
+    expected answer tokens) matches the size of optimal blocks made of
+    average tuples. Blocks of the second table are then filled until the
+    prompt (with answer) for the most expensive block of the first table
+    reaches the token limit. Given selectivity estimates per row of the
+    first table, rows with many expected matches form smaller blocks.
+    Row sizes include their index labels (as in prompt_size).
+    
+    Args:
+        df1: first input table.
+        df2: second input table.
+        s3: size of join result tuples.
+        p: size of static prompt parts.
+        estimate: estimate for join predicate selectivity.
+        row_estimates: optional selectivity estimates for rows of df1.
+        encoding: prompt encoding (determines index labels).
+    
+    Returns:
+        list of blocks for first table, list of blocks for second table.
+    """
+    data_1 = list(df1['text'])
+    data_2 = list(df2['text'])
+    nr_labels = max(len(data_1), len(data_2))
+    labels = [
+        f'{index_label(idx, encoding)}:' for idx in range(1, nr_labels+1)]
+    label_size = max(counter.count_batch(labels), default=0) + 1
+    sizes_1 = [size + label_size for size in counter.count_batch(data_1)]
+    sizes_2 = [size + label_size for size in counter.count_batch(data_2)]
+    if row_estimates is None:
+        row_estimates = [estimate] * len(data_1)
+    
+    s1 = sum(sizes_1) / max(len(sizes_1), 1)
+    s2 = sum(sizes_2) / max(len(sizes_2), 1)
+    b1, b2 = optimal_block_size(s1, s2, s3, t, p, estimate)
+    b1 = max(b1, 1)
+    b2 = max(b2, 1)
+    answer_size = b2 * s3
+    costs_1 = [
+        size + answer_size * row_estimate
+        for size, row_estimate in zip(sizes_1, row_estimates)]
+    budget_1 = b1 * (s1 + answer_size * estimate)
+    groups_1 = pack_rows(costs_1, budget_1)
+    
+    # Prompt for a block from first table: base + slope * rows of block 2
+    bases = [sum(sizes_1[start:end]) for start, end in groups_1]
+    slopes = [
+        s3 * sum(row_estimates[start:end]) for start, end in groups_1]
+    groups_2 = []
+    start = 0
+    tokens_2 = 0
+    for idx, size in enumerate(sizes_2):
+        nr_rows = idx - start + 1
+        prompt_size = p + tokens_2 + size + max(
+            (base + slope * nr_rows for base, slope in zip(bases, slopes)),
+            default=0)
+        if idx > start and prompt_size > t:
+            groups_2.append((start, idx))
+            start = idx
+            tokens_2 = 0
+        tokens_2 += size
+    
+    if start < len(sizes_2):
+        groups_2.append((start, len(sizes_2)))
+    
+    blocks_1 = [data_1[start:end] for start, end in groups_1]
+    blocks_2 = [data_2[start:end] for start, end in groups_2]
+    return blocks_1, blocks_2
+
+
+class AnswerParser():
+    """ Incrementally extracts index pairs from (streamed) answers.
+    
+    Answers are consumed chunk by chunk in a single pass over their
+    characters. Pairs may be separated by semicolons, newlines, or
+    parentheses and may contain spaces (e.g., "(1, 2)\n(3, 4)"). In the
+    grouped encoding, pairs of one group ("x:y,y") may also be listed
+    individually. Each pair is reported once, as soon as it is complete.
+    """
+    
+    def __init__(self, nr_tuples_1, nr_tuples_2, encoding='verbose'):
+        """ Initializes parser for given block sizes.
+        
+        Args:
+            nr_tuples_1: number of entries in first collection.
+            nr_tuples_2: number of entries in second collection.
+            encoding: prompt encoding.
+        """
+        self.nr_tuples_1 = nr_tuples_1
+        self.nr_tuples_2 = nr_tuples_2
+        self.encoding = encoding
+        self.pairs = []
+        self.seen = set()
+        self.label = ''
+        self.labels = []
+        self.group = None
+        self.new_pairs = []
+    
+    def _add(self, label_1, label_2):
+        """ Adds index pair if valid and not yet seen.
+        
+        Args:
+            label_1: label of entry in first collection.
+            label_2: label of entry in second collection.
+        """
+        index_1 = parse_label(label_1, self.encoding)
+        index_2 = parse_label(label_2, self.encoding)
+        if index_1 is not None and index_2 is not None \
+            and 0 <= index_1 < self.nr_tuples_1 \
+            and 0 <= index_2 < self.nr_tuples_2:
+            pair = (index_1, index_2)
+            if pair not in self.seen:
+                self.seen.add(pair)
+                self.pairs.append(pair)
+                self.new_pairs.append(pair)
+    
+    def _end_label(self):
+        """ Completes label that is currently read. """
+        if self.label:
+            self.labels.append(self.label)
+            self.label = ''
+    
+    def _end_pair(self):
+        """ Completes pair (or group) that is currently read. """
+        self._end_label()
+        if self.group is not None:
+            for label in self.labels:
+                self._add(self.group, label)
+        elif len(self.labels) == 2:
+            self._add(*self.labels)
+        self.labels = []
+        self.group = None
+    
+    def _end_pair_member(self):
+        """ Reports pairs of current group as soon as they are complete. """
+        for label in self.labels:
+            self._add(self.group, label)
+        self.labels = []
+    
+    def feed(self, chunk):
+        """ Consumes next part of answer.
+        
+        Args:
+            chunk: text following previously consumed text.
+        
+        Returns:
+            list of index pairs (starting from zero) completed by chunk.
+        """
+        for char in chunk:
+            if char.isalnum() and char.isascii():
+                self.label += char
+            elif char in ';\n)]':
+                self._end_pair()
+            elif char in '([':
+                self.labels = []
+                self.label = ''
+            elif char == ':':
+                self._end_label()
+                if self.encoding == 'grouped' and self.labels:
+                    self.group = self.labels[-1]
+                self.labels = []
+            elif char == ',' and self.group is not None:
+                self._end_label()
+                self._end_pair_member()
+            else:
+                self._end_label()
+        
+        new_pairs = self.new_pairs
+        self.new_pairs = []
+        return new_pairs
+    
+    def restart(self):
+        """ Discards incomplete pair, e.g., if generation is restarted. """
+        self.label = ''
+        self.labels = []
+        self.group = None
+    
+    def finish(self):
+        """ Signals end of (complete) answer.
+        
+        Returns:
+            list of index pairs completed at the end of the answer.
+        """
+        self._end_pair()
+        new_pairs = self.new_pairs
+        self.new_pairs = []
+        return new_pairs
+
+
+def find_indexes(
+        answer, nr_tuples_1, nr_tuples_2, encoding='verbose', complete=True):
+    """ Extract valid index pairs from LLM answer in given encoding.
+    
+    Args:
+        answer: raw text answer generated by LLM.
+        nr_tuples_1: number of entries in first collection.
+        nr_tuples_2: number of entries in second collection.
+        encoding: prompt encoding.
+        complete: whether the answer is complete (otherwise, the last
+            pair may have been truncated and is ignored unless terminated).
+    
+    Returns:
+        List of distinct index pairs (starting from zero) in answer order.
+    """
+    parser = AnswerParser(nr_tuples_1, nr_tuples_2, encoding)
+    parser.feed(answer)
+    if complete:
+        parser.finish()
+    return parser.pairs
+
+
+def parse_label(label, encoding):
+    """ Parses entry label into index.
+    
+    Args:
+        label: entry label (see index_label).
+        encoding: prompt encoding.
+    
+    Returns:
+        index of entry (starting from zero), None if label is invalid.
+    """
+    label = label.strip()
+    if encoding == 'verbose':
+        return int(label) - 1 if label.isdigit() else None
+    elif label.isalnum() and label.isascii():
+        return int(label, 36) - 1
+    else:
+        return None
+
+
+def format_answer(pairs, encoding='verbose'):
+    """ Formats index pairs as expected in answers.
+    
+    Args:
+        pairs: list of index pairs (starting from one) in ascending order.
+        encoding: prompt encoding.
+    
+    Returns:
+        answer text.
+    """
+    if encoding == 'grouped':
+        groups = {}
+        for x, y in pairs:
+            groups.setdefault(x, []).append(index_label(y, encoding))
+        return ';'.join(
+            f'{index_label(x, encoding)}:' + ','.join(ys) 
+            for x, ys in groups.items())
+    else:
+        return ';'.join(
+            f'{index_label(x, encoding)},{index_label(y, encoding)}' 
+            for x, y in pairs)
+
+
+def result_size(encoding, estimate, nr_tuples=30):
+    """ Measures tokens per result tuple in answers of given encoding.
+    
+    The original encoding uses a fixed size of four tokens. For other
+    encodings, an answer listing pairs of a block pair with the given
+    selectivity (spread uniformly) is encoded.
+    
+    Args:
+        encoding: prompt encoding.
+        estimate: selectivity estimate.
+        nr_tuples: number of entries per block in sample answer.
+    
+    Returns:
+        average number of tokens per result tuple.
+    """
+    if encoding == 'verbose':
+        return 4
+    
+    step = max(1, round(1 / max(estimate, 1 / nr_tuples**2)))
+    all_pairs = [
+        (x, y) for x in range(1, nr_tuples+1) 
+        for y in range(1, nr_tuples+1)]
+    pairs = all_pairs[::step]
+    answer = format_answer(pairs, encoding) + ';'
+    return token_size(answer) / len(pairs)
+
+
+def process_answer(
+        answer, block_1, block_2, encoding='verbose', complete=True):
     """ Extract join result from LLM answer.
     
     Args:
         answer: raw text answer generated by LLM.
         block_1: list containing text snippets.
         block_2: list containing text snippets.
+        encoding: prompt encoding.
+        complete: whether the answer is complete (see find_indexes).
     
     Returns:
         List of dictionaries representing join result tuples.
     """
-    nr_tuples_1 = len(block_1)
-    nr_tuples_2 = len(block_2)
     results = []
-    for raw_result in answer.split(';'):
-        raw_indexes = raw_result.split(',')
-        if len(raw_indexes) == 2:
-            raw_indexes = [i.strip() for i in raw_indexes]
-            x_raw, y_raw = raw_indexes
-            if x_raw.isdigit() and y_raw.isdigit():
-                index_1 = int(x_raw) - 1
-                index_2 = int(y_raw) - 1
-                if index_1 >= 0 and index_1 < nr_tuples_1 \
-                    and index_2 >= 0 and index_2 < nr_tuples_2:
-                    tuple_1 = block_1[index_1]
-                    tuple_2 = block_2[index_2]
-                    result = {'tuple1':tuple_1, 'tuple2':tuple_2}
-                    results.append(result)
+    for index_1, index_2 in find_indexes(
+        answer, len(block_1), len(block_2), encoding, complete):
+        tuple_1 = block_1[index_1]
+        tuple_2 = block_2[index_2]
+        result = {'tuple1':tuple_1, 'tuple2':tuple_2}
+        results.append(result)
     
     return results
 
 
-def join_two_blocks(client, block_1, block_2, predicate, model):
-    """ Joins two blocks using the given predicate.
+def complete_prompt(
+        client, prompt, model, limiter=None, cache=None, prompt_tokens=None,
+        on_chunk=None):
+    """ Generates answer to prompt, using at most t tokens in total.
     
     Args:
-        client: OpenAI client.
-        block_1: list of entries from first table.
-        block_2: list of entries from second table.
-        predicate: join predicate as text.
+        client: OpenAI client or backend.
+        prompt: prompt listing index pairs (terminated by "Finished").
         model: name of OpenAI model to use.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        prompt_tokens: token size of prompt (None: encode prompt).
+        on_chunk: optional function called on parts of the answer as
+            soon as they are generated (answer is streamed if given),
+            called on None if generation restarts after an error.
     
     Returns:
-        Statistics, join result.
+        Statistics, answer (answer is empty if the prompt is too long).
+        Statistics include input tokens read from the provider's prompt
+        cache, if reported by the backend.
     """
     start_s = time.time()
-    prompt = create_prompt(block_1, block_2, predicate)
     print(f'---\n{prompt}\n---')
-    messages = [{'role':'user', 'content':prompt}]
-    max_tokens = t - token_size(prompt)
+    backend = get_backend(client)
+    if prompt_tokens is None:
+        prompt_tokens = len(encoder.encode(prompt))
+    max_tokens = t - prompt_tokens
+    cache_hits = 0
+    cache_misses = 0
     
     if max_tokens >= 1:
         
-        max_retries = 3
-        for nr_retries in range(max_retries+1):
-            try:
-                response = client.chat.completions.create(
-                    messages=messages, model=model, 
-                    max_tokens=max_tokens, temperature=0,
-                    stop=['Finished'])
-                break
-            except Exception as e:
-                print(f'Exception while calling OpenAI model: {e}')
-                print(f'Used {nr_retries} retries.')
-                if nr_retries < max_retries:
-                    time.sleep(5**nr_retries)
-                else:
-                    raise BaseException('Cannot contact OpenAI!')
+        stop = ['Finished']
+        key = completion_key(model, prompt, max_tokens, 0, stop)
+        cached = None if cache is None else cache.lookup(key)
+        if cached is None:
             
-        print(response)
-        answer = response.choices[0].message.content
+            max_retries = 3
+            for nr_retries in range(max_retries+1):
+                try:
+                    if limiter is not None:
+                        limiter.acquire(t)
+                    kwargs = {} if on_chunk is None else \
+                        {'on_chunk':on_chunk}
+                    response = backend.complete(
+                        prompt, model, max_tokens, stop, **kwargs)
+                    break
+                except Exception as e:
+                    print(f'Exception while calling OpenAI model: {e}')
+                    print(f'Used {nr_retries} retries.')
+                    if on_chunk is not None:
+                        on_chunk(None)
+                    if nr_retries < max_retries:
+                        time.sleep(5**nr_retries)
+                    else:
+                        raise BaseException('Cannot contact OpenAI!')
+            
+            print(response)
+            answer = response['answer']
+            finish_reason = response['finish_reason']
+            tokens_read = response['tokens_read']
+            tokens_written = response['tokens_written']
+            cached_tokens = response.get('cached_tokens', 0)
+            if cache is not None:
+                cache_misses = 1
+                cache.store(key, {
+                    'answer':answer, 'finish_reason':finish_reason})
+        else:
+            answer = cached['answer']
+            finish_reason = cached['finish_reason']
+            tokens_read = 0
+            tokens_written = 0
+            cached_tokens = 0
+            cache_hits = 1
+            if on_chunk is not None:
+                on_chunk(answer)
+        
         print(f'Answer: {answer}')
-        overflow = not (response.choices[0].finish_reason == 'stop')
+        overflow = not (finish_reason == 'stop')
         print(f'Overflow: {overflow}\n')
-        tokens_read = response.usage.prompt_tokens
-        tokens_written = response.usage.completion_tokens
-        results = process_answer(answer, block_1, block_2)
     else:
+        answer = ''
         tokens_read = 0
         tokens_written = 0
+        cached_tokens = 0
         overflow = True
-        results = []
     
     total_s = time.time() - start_s
     stats = {
         'tokens_read':tokens_read, 
         'tokens_written':tokens_written,
+        'cached_tokens':cached_tokens,
         'seconds':total_s,
-        'overflow':overflow}
+        'overflow':overflow,
+        'cache_hits':cache_hits,
+        'cache_misses':cache_misses}
+    
+    return stats, answer
+
 
+def join_two_blocks(
+        client, block_1, block_2, predicate, model, 
+        limiter=None, cache=None, encoding='verbose', prefix=None, 
+        on_result=None):
+    """ Joins two blocks using the given predicate.
+    
+    If a result handler is given, the answer is streamed and parsed
+    incrementally. Each result tuple is passed to the handler as soon
+    as the corresponding index pair is complete. Tuples from failed
+    and retried requests are not revoked.
+    
+    Args:
+        client: OpenAI client or backend.
+        block_1: list of entries from first table.
+        block_2: list of entries from second table.
+        predicate: join predicate as text.
+        model: name of OpenAI model to use.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        encoding: prompt encoding (see create_prompt).
+        prefix: collection listed first (see create_prompt).
+        on_result: optional function called on each result tuple.
+    
+    Returns:
+        Statistics, join result.
+    """
+    prompt = create_prompt(
+        block_1, block_2, predicate, encoding=encoding, prefix=prefix)
+    prompt_tokens = prompt_size(
+        block_1, block_2, predicate, encoding=encoding)
+    if on_result is None:
+        stats, answer = complete_prompt(
+            client, prompt, model, limiter, cache, prompt_tokens)
+        stats['data_tokens'] = data_size(block_1, block_2)
+        results = process_answer(
+            answer, block_1, block_2, encoding, not stats['overflow'])
+        return stats, results
+    
+    parser = AnswerParser(len(block_1), len(block_2), encoding)
+    
+    def handle(pairs):
+        """ Passes result tuples for index pairs to handler.
+        
+        Args:
+            pairs: list of index pairs (starting from zero).
+        """
+        for index_1, index_2 in pairs:
+            on_result({'tuple1':block_1[index_1], 'tuple2':block_2[index_2]})
+    
+    def on_chunk(chunk):
+        """ Parses next part of streamed answer.
+        
+        Args:
+            chunk: part of answer (None if generation restarts).
+        """
+        if chunk is None:
+            parser.restart()
+        else:
+            handle(parser.feed(chunk))
+    
+    stats, _ = complete_prompt(
+        client, prompt, model, limiter, cache, prompt_tokens, on_chunk)
+    stats['data_tokens'] = data_size(block_1, block_2)
+    if not stats['overflow']:
+        handle(parser.finish())
+    results = [
+        {'tuple1':block_1[index_1], 'tuple2':block_2[index_2]} 
+        for index_1, index_2 in parser.pairs]
     return stats, results
 
 
-def block_join(client, df1, df2, predicate, model, estimate=1):
-    """ Performs block join between two tables.
+def join_with_recovery(
+        client, block_1, block_2, predicate, model, 
+        limiter=None, cache=None, encoding='verbose', prefix=None):
+    """ Joins two blocks, splitting them locally after overflows.
+    
+    After an overflow, index pairs before the truncation point are kept.
+    If pairs are listed in ascending order of the first index, entries
+    of the first block before the last listed one count as covered. The
+    remaining entries are split into halves (or the second block, if a
+    single entry remains) and each half is joined recursively.
+    
+    Args:
+        client: OpenAI client or backend.
+        block_1: list of entries from first table.
+        block_2: list of entries from second table.
+        predicate: join predicate as text.
+        model: name of OpenAI model to use.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        encoding: prompt encoding (see create_prompt).
+        prefix: collection listed first (see create_prompt).
+    
+    Returns:
+        Statistics (summed over invocations), join result.
+    """
+    stats = {
+        'tokens_read':0, 'tokens_written':0, 'cached_tokens':0, 
+        'seconds':0, 'overflow':False, 'cache_hits':0, 'cache_misses':0,
+        'invocations':0, 'recoveries':0, 'data_tokens':0}
+    found = {}
+    todo = [(list(range(len(block_1))), list(range(len(block_2))))]
+    while todo:
+        indexes_1, indexes_2 = todo.pop()
+        sub_block_1 = [block_1[idx] for idx in indexes_1]
+        sub_block_2 = [block_2[idx] for idx in indexes_2]
+        prompt = create_prompt(
+            sub_block_1, sub_block_2, predicate, 
+            encoding=encoding, prefix=prefix)
+        prompt_tokens = prompt_size(
+            sub_block_1, sub_block_2, predicate, encoding=encoding)
+        sub_stats, answer = complete_prompt(
+            client, prompt, model, limiter, cache, prompt_tokens)
+        for key, value in sub_stats.items():
+            if key != 'overflow':
+                stats[key] += value
+        stats['invocations'] += 1
+        stats['data_tokens'] += data_size(sub_block_1, sub_block_2)
+        
+        pairs = find_indexes(
+            answer, len(sub_block_1), len(sub_block_2), encoding, 
+            not sub_stats['overflow'])
+        for x, y in pairs:
+            idx_1 = indexes_1[x]
+            idx_2 = indexes_2[y]
+            found[(idx_1, idx_2)] = {
+                'tuple1':block_1[idx_1], 'tuple2':block_2[idx_2]}
+        
+        if sub_stats['overflow']:
+            xs = [x for x, _ in pairs]
+            first_open = xs[-1] if xs and xs == sorted(xs) else 0
+            open_1 = indexes_1[first_open:]
+            if len(open_1) > 1:
+                middle = len(open_1) // 2
+                todo.append((open_1[middle:], indexes_2))
+                todo.append((open_1[:middle], indexes_2))
+            elif len(indexes_2) > 1:
+                middle = len(indexes_2) // 2
+                todo.append((open_1, indexes_2[middle:]))
+                todo.append((open_1, indexes_2[:middle]))
+            else:
+                print('Cannot split overflowing block pair further!')
+                stats['overflow'] = True
+                break
+            stats['recoveries'] += 1
+    
+    return stats, list(found.values())
+
+
+def join_with_continuation(
+        client, block_1, block_2, predicate, model, 
+        limiter=None, cache=None, encoding='verbose', prefix=None,
+        max_continuations=8):
+    """ Joins two blocks, continuing truncated answers with new prompts.
+    
+    After an overflow, index pairs before the truncation point are kept
+    and a follow-up prompt asks for the pairs after the last one emitted.
+    This assumes that pairs are listed in ascending order. Continuation
+    stops (and the overflow is reported) if an answer makes no progress.
     
     Args:
-        client: OpenAI client.
+        client: OpenAI client or backend.
+        block_1: list of entries from first table.
+        block_2: list of entries from second table.
+        predicate: join predicate as text.
+        model: name of OpenAI model to use.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        encoding: prompt encoding (see create_prompt).
+        prefix: collection listed first (see create_prompt).
+        max_continuations: maximal number of follow-up prompts.
+    
+    Returns:
+        Statistics (summed over invocations), join result.
+    """
+    stats = {
+        'tokens_read':0, 'tokens_written':0, 'cached_tokens':0, 
+        'seconds':0, 'overflow':False, 'cache_hits':0, 'cache_misses':0,
+        'continuations':0, 'continuation_tokens_read':0,
+        'invocations':0, 'data_tokens':0}
+    block_tokens = data_size(block_1, block_2)
+    found = {}
+    last_pair = None
+    for nr_continuations in range(max_continuations+1):
+        prompt = create_prompt(
+            block_1, block_2, predicate, last_pair, encoding, prefix)
+        prompt_tokens = prompt_size(
+            block_1, block_2, predicate, last_pair, encoding)
+        sub_stats, answer = complete_prompt(
+            client, prompt, model, limiter, cache, prompt_tokens)
+        for key, value in sub_stats.items():
+            if key != 'overflow':
+                stats[key] += value
+        stats['invocations'] += 1
+        stats['data_tokens'] += block_tokens
+        if nr_continuations > 0:
+            stats['continuations'] += 1
+            stats['continuation_tokens_read'] += sub_stats['tokens_read']
+        
+        overflow = sub_stats['overflow']
+        pairs = find_indexes(
+            answer, len(block_1), len(block_2), encoding, not overflow)
+        for idx_1, idx_2 in pairs:
+            found[(idx_1, idx_2)] = {
+                'tuple1':block_1[idx_1], 'tuple2':block_2[idx_2]}
+        
+        if not overflow:
+            break
+        if not pairs or (last_pair is not None and pairs[-1] <= last_pair):
+            print('Continuation makes no progress!')
+            break
+        last_pair = pairs[-1]
+    
+    stats['overflow'] = overflow
+    return stats, list(found.values())
+
+
+def estimate_selectivity(
+        client, df1, df2, predicate, model, nr_probes=4, probe_size=5,
+        confidence=0.95, seed=0, parallelism=1, limiter=None, cache=None,
+        nr_regions=1):
+    """ Estimates join selectivity by joining small samples of tuples.
+    
+    Besides the estimate for the entire table, an upper bound is
+    calculated separately for each region of the first table.
+    
+    Args:
+        client: OpenAI client or backend.
         df1: first input table.
         df2: second input table.
         predicate: compare entries using this predicate.
         model: name of OpenAI model to use.
-        estimate: estimate for join predicate selectivity.
+        nr_probes: number of sampled block pairs to join.
+        probe_size: number of tuples per sampled block.
+        confidence: probability that selectivity is below returned bound.
+        seed: seed for sampling tuples.
+        parallelism: maximal number of concurrent LLM invocations.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        nr_regions: number of regions in first table (see sample_blocks).
     
     Returns:
-        A tuple: (performance statistics, join result).
+        estimate, upper bound, upper bound per region, statistics per probe.
+    """
+    probes = sample_blocks(
+        df1, df2, nr_probes, probe_size, seed, nr_regions)
+    
+    def join_probe(probe):
+        """ Joins one sampled block pair.
+        
+        Args:
+            probe: region index and pair of sampled blocks.
+        
+        Returns:
+            Statistics, number of matching pairs and of all pairs.
+        """
+        _, block_1, block_2 = probe
+        stats, results = join_two_blocks(
+            client, block_1, block_2, predicate, model, limiter, cache)
+        nr_pairs = len(block_1) * len(block_2)
+        matches = set((r['tuple1'], r['tuple2']) for r in results)
+        return stats, min(len(matches), nr_pairs), nr_pairs
+    
+    stats = []
+    region_matches = [0] * nr_regions
+    region_pairs = [0] * nr_regions
+    with contextlib.closing(
+        ordered_map(join_probe, probes, parallelism)) as probe_results:
+        for (region, _, _), (stat, probe_matches, probe_pairs) in zip(
+            probes, probe_results):
+            # Overflowing probes have incomplete answers
+            if not stat['overflow']:
+                region_matches[region] += probe_matches
+                region_pairs[region] += probe_pairs
+            stats.append(stat)
+    
+    nr_matches = sum(region_matches)
+    nr_pairs = sum(region_pairs)
+    estimate = nr_matches / nr_pairs if nr_pairs else 1.0
+    bound = upper_bound(nr_matches, nr_pairs, confidence)
+    region_estimates = [
+        upper_bound(m, n, confidence) 
+        for m, n in zip(region_matches, region_pairs)]
+    print(
+        f'Sampled {nr_matches} matches out of {nr_pairs} pairs: '
+        f'selectivity estimate {estimate}, upper bound {bound}')
+    return estimate, bound, region_estimates, stats
+
+
+def check_self_join(df1, df2):
+    """ Verifies that a symmetric join compares a table with itself.
+    
+    Args:
+        df1: first input table.
+        df2: second input table.
+    
+    Raises:
+        ValueError if the tables contain different texts.
+    """
+    if fingerprint(df1['text']) != fingerprint(df2['text']):
+        raise ValueError('Symmetric joins require identical tables!')
+
+
+def mirror(results):
+    """ Swaps tuples of join results (for symmetric predicates).
+    
+    Args:
+        results: list of join result tuples.
+    
+    Returns:
+        list of result tuples with swapped components.
+    """
+    return [{'tuple1':r['tuple2'], 'tuple2':r['tuple1']} for r in results]
+
+
+def prefix_collection(blocks_1, blocks_2):
+    """ Chooses collection whose blocks are kept fixed across prompts.
+    
+    Each block of the chosen collection is listed first in prompts for
+    all blocks of the other collection, joined consecutively. Hence,
+    all but the first of those prompts read the fixed block from the
+    prompt cache. The collection maximizing cached tokens is chosen.
+    
+    Args:
+        blocks_1: blocks of first table.
+        blocks_2: blocks of second table.
+    
+    Returns:
+        1 or 2, the collection whose blocks are listed first.
+    """
+    tokens_1 = sum(sum(counter.count_batch(block)) for block in blocks_1)
+    tokens_2 = sum(sum(counter.count_batch(block)) for block in blocks_2)
+    cached_1 = tokens_1 * (len(blocks_2) - 1)
+    cached_2 = tokens_2 * (len(blocks_1) - 1)
+    return 1 if cached_1 >= cached_2 else 2
+
+
+def block_join_stream(
+        client, df1, df2, predicate, model, estimate=1, 
+        parallelism=1, limiter=None, cache=None, checkpoint_path=None,
+        nr_probes=0, probe_size=5, confidence=0.95, partitioning='count',
+        recover=False, continuation=False, encoding='verbose',
+        on_result=None, prefix_reuse=False, symmetric=False):
+    """ Performs block join, producing results for each block pair.
+    
+    Block pairs are joined concurrently if parallelism exceeds one.
+    Statistics and results are produced in the same order as for
+    sequential processing. The join stops after the first overflow that
+    cannot be resolved. Outstanding invocations are cancelled if the
+    caller stops iterating.
+    
+    Args:
+        client: OpenAI client or backend.
+        df1: first input table.
+        df2: second input table.
+        predicate: compare entries using this predicate.
+        model: name of OpenAI model to use.
+        estimate: estimate for join predicate selectivity (ignored if
+            probes are requested).
+        parallelism: maximal number of concurrent LLM invocations.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        checkpoint_path: optional path to log of joined block pairs
+            (block pairs logged by previous runs are skipped).
+        nr_probes: number of sampled block pairs for estimating 
+            selectivity (see estimate_selectivity).
+        probe_size: number of tuples per sampled block.
+        confidence: probability that selectivity is below estimate used.
+        partitioning: how to partition tables ("count" by tuple count,
+            "tokens" by token size, see token_partition, or "skew" by 
+            token size and sampled selectivity per region).
+        recover: whether to split overflowing blocks (see 
+            join_with_recovery).
+        continuation: whether to continue truncated answers (see 
+            join_with_continuation).
+        encoding: prompt encoding ("verbose", "compact", or "grouped").
+        on_result: optional function called on each result tuple, 
+            possibly from concurrent threads (see join_two_blocks).
+        prefix_reuse: whether to order prompts for prefix caching (see 
+            prefix_collection).
+        symmetric: whether to exploit a symmetric predicate in a 
+            self-join (only block pairs on or above the diagonal are
+            joined, their results are mirrored).
+    
+    Returns:
+        A generator over (statistics, join result) per block pair.
     """
-    s1 = tuple_size(df1)
-    s2 = tuple_size(df2)
-    s3 = 4
+    if partitioning == 'skew' and nr_probes < 1:
+        raise ValueError('Skew-aware partitioning requires probes!')
+    if recover and continuation:
+        raise ValueError('Choose either recovery or continuation!')
+    if on_result is not None and (recover or continuation):
+        raise ValueError('Result handlers require plain block joins!')
+    if symmetric:
+        check_self_join(df1, df2)
+    
+    sample_info = {}
+    row_estimates = None
+    if nr_probes > 0:
+        nr_regions = nr_probes if partitioning == 'skew' else 1
+        sample_estimate, estimate, region_estimates, sample_stats = \
+            estimate_selectivity(
+                client, df1, df2, predicate, model, nr_probes, probe_size,
+                confidence, parallelism=parallelism, 
+                limiter=limiter, cache=cache, nr_regions=nr_regions)
+        if partitioning == 'skew':
+            row_estimates = []
+            for region, region_estimate in enumerate(region_estimates):
+                start, end = region_bounds(len(df1), nr_regions, region)
+                row_estimates += [region_estimate] * (end - start)
+        sample_info = {
+            'sample_estimate':sample_estimate, 'sample_bound':estimate}
+        for stat in sample_stats:
+            stat = stat | {'phase':'sample'} | sample_info
+            if checkpoint_path is not None:
+                stat['resumed'] = False
+            yield stat, []
+        sample_info['phase'] = 'join'
     
-    static_prompt = create_prompt([], [], predicate)
+    s3 = result_size(encoding, estimate)
+    static_prompt = create_prompt([], [], predicate, encoding=encoding)
     p = token_size(static_prompt)
     
     print(p)
     print(t)
-    b1, b2 = optimal_block_size(s1, s2, s3, t, p, estimate)
-    blocks_1 = partition(df1, b1)
-    blocks_2 = partition(df2, b2)
+    if partitioning == 'count':
+        s1 = tuple_size(df1)
+        s2 = tuple_size(df2)
+        b1, b2 = optimal_block_size(s1, s2, s3, t, p, estimate)
+        blocks_1 = partition(df1, b1)
+        blocks_2 = partition(df2, b2)
+    else:
+        blocks_1, blocks_2 = token_partition(
+            df1, df2, s3, p, estimate, row_estimates, encoding)
+        b1 = [len(block) for block in blocks_1]
+        b2 = [len(block) for block in blocks_2]
+    if symmetric:
+        # Use finer partitioning for both tables (keeps prompts small)
+        if len(blocks_2) > len(blocks_1):
+            blocks_1, b1 = blocks_2, b2
+        blocks_2, b2 = blocks_1, b1
     nr_blocks_1 = len(blocks_1)
     nr_blocks_2 = len(blocks_2)
+    prefix = prefix_collection(blocks_1, blocks_2) if prefix_reuse else None
     
-    stats = []
-    results = []
-    overflow = False
-    for idx_1, block_1 in enumerate(blocks_1, 1):
-        if overflow:
-            break
-        for idx_2, block_2 in enumerate(blocks_2, 1):
-            print(
-                f'Joining block {idx_1}/{nr_blocks_1} from table 1 '
-                f'with block {idx_2}/{nr_blocks_2} from table 2 ...')
-            stat, result = join_two_blocks(
-                client, block_1, block_2, 
-                predicate, model)
-            overflow = stat['overflow']
-            stats.append(stat)
-            results += result
-            if overflow:
-                break
+    checkpoint = None
+    if checkpoint_path is not None:
+        join_id = {
+            'table_1':fingerprint(df1['text']), 
+            'table_2':fingerprint(df2['text']), 
+            'predicate':predicate, 'model':model, 
+            'b1':b1, 'b2':b2, 't':t}
+        if recover:
+            join_id['recover'] = True
+        if continuation:
+            join_id['continuation'] = True
+        if encoding != 'verbose':
+            join_id['encoding'] = encoding
+        if symmetric:
+            join_id['symmetric'] = True
+        checkpoint = Checkpoint(checkpoint_path, join_id)
+    
+    def join_pair(pair):
+        """ Joins one pair of blocks.
+        
+        Args:
+            pair: tuple of block indexes and blocks.
+        
+        Returns:
+            Statistics, join result.
+        """
+        idx_1, block_1, idx_2, block_2 = pair
+        if checkpoint is not None:
+            completed = checkpoint.lookup(idx_1, idx_2)
+            if completed is not None:
+                stats, results = completed
+                return stats | {'resumed':True}, results
+        
+        print(
+            f'Joining block {idx_1}/{nr_blocks_1} from table 1 '
+            f'with block {idx_2}/{nr_blocks_2} from table 2 ...')
+        mirrored = symmetric and idx_1 < idx_2
+        
+        def handler(result):
+            """ Passes result (and its mirror, if needed) to handler.
+            
+            Args:
+                result: join result tuple.
+            """
+            on_result(result)
+            if mirrored:
+                on_result(mirror([result])[0])
+        
+        if continuation:
+            join_blocks = join_with_continuation
+        elif recover:
+            join_blocks = join_with_recovery
+        else:
+            join_blocks = functools.partial(
+                join_two_blocks, 
+                on_result=None if on_result is None else handler)
+        stats, results = join_blocks(
+            client, block_1, block_2, 
+            predicate, model, limiter, cache, encoding, prefix)
+        if mirrored:
+            results = results + mirror(results)
+        if checkpoint is not None:
+            checkpoint.record(idx_1, idx_2, stats, results)
+            stats = stats | {'resumed':False}
+        return stats, results
     
-    return stats, results
\ No newline at end of file
+    if symmetric:
+        pairs = (
+            (idx_1, block_1, idx_2, block_2) 
+            for idx_1, block_1 in enumerate(blocks_1, 1) 
+            for idx_2, block_2 in enumerate(blocks_2, 1)
+            if idx_1 <= idx_2)
+    elif prefix == 2:
+        pairs = (
+            (idx_1, block_1, idx_2, block_2) 
+            for idx_2, block_2 in enumerate(blocks_2, 1)
+            for idx_1, block_1 in enumerate(blocks_1, 1))
+    else:
+        pairs = (
+            (idx_1, block_1, idx_2, block_2) 
+            for idx_1, block_1 in enumerate(blocks_1, 1) 
+            for idx_2, block_2 in enumerate(blocks_2, 1))
+    
+    try:
+        with contextlib.closing(
+            ordered_map(join_pair, pairs, parallelism)) as pair_results:
+            for stat, result in pair_results:
+                yield stat | sample_info, result
+                if stat['overflow']:
+                    break
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+def block_join(
+        client, df1, df2, predicate, model, estimate=1, 
+        parallelism=1, limiter=None, cache=None, checkpoint_path=None,
+        nr_probes=0, probe_size=5, confidence=0.95, partitioning='count',
+        recover=False, continuation=False, encoding='verbose',
+        on_result=None, prefix_reuse=False, symmetric=False):
+    """ Performs block join between two tables.
+    
+    Args:
+        client: OpenAI client or backend.
+        df1: first input table.
+        df2: second input table.
+        predicate: compare entries using this predicate.
+        model: name of OpenAI model to use.
+        estimate: estimate for join predicate selectivity.
+        parallelism: maximal number of concurrent LLM invocations.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        checkpoint_path: optional path to log of joined block pairs.
+        nr_probes: number of sampled block pairs for estimating selectivity.
+        probe_size: number of tuples per sampled block.
+        confidence: probability that selectivity is below estimate used.
+        partitioning: how to partition tables ("count", "tokens", "skew").
+        recover: whether to recover from overflows by splitting blocks.
+        continuation: whether to continue truncated answers.
+        encoding: prompt encoding ("verbose", "compact", or "grouped").
+        on_result: optional function called on each result tuple.
+        prefix_reuse: whether to order prompts for prefix caching.
+        symmetric: whether to exploit a symmetric predicate in a self-join.
+    
+    Returns:
+        A tuple: (performance statistics, join result).
+    """
+    return collect(block_join_stream(
+        client, df1, df2, predicate, model, estimate=estimate,
+        parallelism=parallelism, limiter=limiter, cache=cache,
+        checkpoint_path=checkpoint_path, nr_probes=nr_probes,
+        probe_size=probe_size, confidence=confidence,
+        partitioning=partitioning, recover=recover,
+        continuation=continuation, encoding=encoding, on_result=on_result,
+        prefix_reuse=prefix_reuse, symmetric=symmetric))
@@ -0,0 +1,153 @@
+'''
+Created on Oct 17, 2026
+
+@author: immanueltrummer
+'''
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def completion_key(model, prompt, max_tokens, temperature, stop):
+    """ Calculates cache key for a chat completion request.
+
+    Args:
+        model: name of OpenAI model.
+        prompt: prompt text.
+        max_tokens: maximal number of generated tokens.
+        temperature: sampling temperature.
+        stop: list of stop sequences (or None).
+
+    Returns:
+        key identifying the request.
+    """
+    prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    request = ['completion', model, prompt_hash, max_tokens, temperature, stop]
+    return hashlib.sha256(json.dumps(request).encode('utf-8')).hexdigest()
+
+
+def embedding_key(model, text):
+    """ Calculates cache key for an embedding request.
+
+    Args:
+        model: name of embedding model.
+        text: embedded text.
+
+    Returns:
+        key identifying the request.
+    """
+    text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    request = ['embedding', model, text_hash]
+    return hashlib.sha256(json.dumps(request).encode('utf-8')).hexdigest()
+
+
+def fingerprint(texts):
+    """ Calculates fingerprint identifying a list of texts.
+    
+    Args:
+        texts: list of texts.
+    
+    Returns:
+        hash of texts.
+    """
+    text_hash = hashlib.sha256()
+    for text in texts:
+        text_hash.update(text.encode('utf-8'))
+        text_hash.update(b'\0')
+    return text_hash.hexdigest()
+
+
+class ResponseCache():
+    """ Persistent cache for LLM responses, stored in SQLite.
+
+    Entries are evicted in least-recently-used order once the total
+    size of cached responses exceeds the size limit.
+    """
+
+    def __init__(self, path='llm_cache.db', max_bytes=1024*1024*1024):
+        """ Opens (and creates, if necessary) cache database.
+
+        Args:
+            path: path to SQLite database file.
+            max_bytes: maximal size of cached responses in bytes.
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses('
+            'key TEXT PRIMARY KEY, value TEXT, '
+            'size INTEGER, last_access REAL)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS access_idx '
+            'ON responses(last_access)')
+        self.connection.commit()
+        self.nr_bytes = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def lookup(self, key):
+        """ Retrieves cached response and updates hit/miss counters.
+
+        Args:
+            key: cache key of request.
+
+        Returns:
+            dictionary describing response or None if not cached.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value FROM responses WHERE key=?',
+                (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.connection.execute(
+                'UPDATE responses SET last_access=? WHERE key=?',
+                (time.time(), key))
+            self.connection.commit()
+            return json.loads(row[0])
+
+    def store(self, key, response):
+        """ Stores response in cache and evicts entries if necessary.
+
+        Args:
+            key: cache key of request.
+            response: dictionary describing response (JSON-serializable).
+        """
+        value = json.dumps(response)
+        size = len(value)
+        with self.lock:
+            old_row = self.connection.execute(
+                'SELECT size FROM responses WHERE key=?',
+                (key,)).fetchone()
+            if old_row is not None:
+                self.nr_bytes -= old_row[0]
+
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                (key, value, size, time.time()))
+            self.nr_bytes += size
+
+            while self.nr_bytes > self.max_bytes:
+                oldest = self.connection.execute(
+                    'SELECT key, size FROM responses '
+                    'ORDER BY last_access LIMIT 1').fetchone()
+                if oldest is None:
+                    break
+                old_key, old_size = oldest
+                self.connection.execute(
+                    'DELETE FROM responses WHERE key=?', (old_key,))
+                self.nr_bytes -= old_size
+
+            self.connection.commit()
+
+    def close(self):
+        """ Closes cache database. """
+        self.connection.close()
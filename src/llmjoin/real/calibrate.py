@@ -0,0 +1,213 @@
+'''
+Created on Oct 17, 2026
+
+@author: immanueltrummer
+'''
+from argparse import ArgumentParser
+from llmjoin.simulated.simulator import fit_latency
+from pandas import concat
+from pandas import read_csv
+from pathlib import Path
+import json
+
+
+operators = [
+    'tuple_join', 'block_join', 'adaptive_join',
+    'embedding_join', 'hybrid_join', 'planned_join']
+
+
+def read_runs(result_dir):
+    """ Reads statistics and results of real runs.
+    
+    Args:
+        result_dir: directory containing files written by run_real.
+    
+    Returns:
+        list of (operator, scenario, statistics, results) tuples.
+    """
+    runs = []
+    for stats_path in sorted(Path(result_dir).glob('*_stats.csv')):
+        name = stats_path.name[:-len('_stats.csv')]
+        op_name = next(
+            (op for op in operators if name.startswith(f'{op}_')), None)
+        if op_name is None:
+            continue
+        
+        scenario = name[len(op_name)+1:]
+        stats = read_csv(str(stats_path))
+        results_path = stats_path.with_name(f'{name}_results.csv')
+        results = read_csv(str(results_path)) \
+            if results_path.exists() else None
+        runs.append((op_name, scenario, stats, results))
+    
+    return runs
+
+
+def llm_calls(stats):
+    """ Selects statistics of invocations that reached the LLM.
+    
+    Args:
+        stats: statistics of one run.
+    
+    Returns:
+        rows without cache hits that read tokens.
+    """
+    calls = stats[stats['tokens_read'] > 0]
+    if 'cache_hits' in calls.columns:
+        calls = calls[calls['cache_hits'].fillna(0) == 0]
+    return calls
+
+
+def nr_invocations(calls):
+    """ Counts LLM invocations represented by statistics rows.
+    
+    Args:
+        calls: statistics rows.
+    
+    Returns:
+        number of invocations (rows may aggregate several invocations).
+    """
+    if 'invocations' in calls.columns:
+        return calls['invocations'].fillna(1).sum()
+    else:
+        return len(calls)
+
+
+def fit_prompt_size(stats):
+    """ Fits size of static prompt parts (including chat formatting).
+    
+    Args:
+        stats: statistics with tokens read and tokens of data in prompts.
+    
+    Returns:
+        average prompt size without data, None if not available.
+    """
+    if 'data_tokens' not in stats.columns:
+        return None
+    
+    calls = llm_calls(stats).dropna(subset=['data_tokens'])
+    if calls.empty:
+        return None
+    
+    overhead = (calls['tokens_read'] - calls['data_tokens']).sum()
+    return overhead / nr_invocations(calls)
+
+
+def fit_result_size(block_runs):
+    """ Fits number of tokens generated per result tuple.
+    
+    Only runs without overflows and cache hits are considered, since
+    their written tokens correspond exactly to the results.
+    
+    Args:
+        block_runs: list of (statistics, results) of block joins.
+    
+    Returns:
+        tokens written per result tuple, None if not available.
+    """
+    tokens_written = 0
+    nr_results = 0
+    for stats, results in block_runs:
+        if results is None or stats['overflow'].fillna(False).any():
+            continue
+        if 'cache_hits' in stats.columns and stats['cache_hits'].sum():
+            continue
+        tokens_written += stats['tokens_written'].sum()
+        nr_results += len(results)
+    
+    return tokens_written / nr_results if nr_results else None
+
+
+def fit_overflows(block_stats):
+    """ Fits token limit at which answers are truncated.
+    
+    Args:
+        block_stats: statistics of block join invocations.
+    
+    Returns:
+        overflow rate and median tokens per overflowing invocation.
+    """
+    calls = llm_calls(block_stats)
+    if 'invocations' in calls.columns:
+        calls = calls[calls['invocations'].fillna(1) == 1]
+    if calls.empty:
+        return None, None
+    
+    overflows = calls[calls['overflow'].fillna(False).astype(bool)]
+    overflow_rate = len(overflows) / len(calls)
+    if overflows.empty:
+        return overflow_rate, None
+    
+    total_tokens = overflows['tokens_read'] + overflows['tokens_written']
+    return overflow_rate, int(total_tokens.median())
+
+
+def calibrate(runs, concurrency=1):
+    """ Fits simulation parameters to statistics of real runs.
+    
+    Args:
+        runs: list of (operator, scenario, statistics, results) tuples.
+        concurrency: number of concurrent invocations for latency model.
+    
+    Returns:
+        dictionary with fitted parameters (omitting unavailable ones).
+    """
+    tuple_stats = [
+        stats for op, _, stats, _ in runs if op == 'tuple_join']
+    block_runs = [
+        (stats, results) for op, _, stats, results in runs
+        if op in ['block_join', 'adaptive_join']]
+    block_stats = [stats for stats, _ in block_runs]
+    
+    profile = {}
+    s3 = fit_result_size(block_runs)
+    if s3 is not None:
+        profile['s3'] = s3
+    
+    if tuple_stats:
+        p_tuple = fit_prompt_size(concat(tuple_stats))
+        if p_tuple is not None:
+            # The simulator adds s3 to tuple join prompts
+            profile['p_tuple'] = p_tuple - profile.get('s3', 0)
+    
+    if block_stats:
+        all_block_stats = concat(block_stats)
+        p_block = fit_prompt_size(all_block_stats)
+        if p_block is not None:
+            profile['p_block'] = p_block
+        # The simulator derives overflows from t (the rate is informative)
+        overflow_rate, t = fit_overflows(all_block_stats)
+        if overflow_rate is not None:
+            print(f'Overflow rate:\t{overflow_rate}')
+        if t is not None:
+            profile['t'] = t
+    
+    llm_stats = tuple_stats + block_stats
+    if llm_stats:
+        try:
+            profile['latency'] = fit_latency(
+                concat(llm_stats), concurrency)
+        except ValueError as e:
+            print(f'Cannot fit latency: {e}')
+    
+    profile['nr_runs'] = len(runs)
+    return profile
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('dir', type=str, help='Path to result directory')
+    parser.add_argument('out_file', type=str, help='Path to profile (.json)')
+    parser.add_argument(
+        '--concurrency', type=int, default=1,
+        help='Concurrent invocations assumed by latency model')
+    args = parser.parse_args()
+    
+    runs = read_runs(args.dir)
+    profile = calibrate(runs, args.concurrency)
+    for name, value in profile.items():
+        print(f'{name}:\t{value}')
+    
+    with open(args.out_file, 'w') as file:
+        json.dump(profile, file, indent=2)
@@ -0,0 +1,92 @@
+'''
+Created on Oct 17, 2026
+
+@author: immanueltrummer
+'''
+import hashlib
+import json
+import os
+import threading
+
+
+class Checkpoint():
+    """ Append-only log of block pairs that were already joined.
+    
+    The log is a text file with one JSON record per line. Each record
+    stores statistics and results for one block pair, together with a
+    key identifying the join (inputs, predicate, model, and block sizes).
+    Records of other joins (e.g., with other block sizes) are ignored,
+    so one file can be shared across multiple joins.
+    """
+    
+    def __init__(self, path, join_id, fsync=False):
+        """ Loads completed block pairs from log (if it exists).
+        
+        Args:
+            path: path to log file.
+            join_id: dictionary identifying the join (JSON-serializable).
+            fsync: whether to force each record to disk.
+        """
+        self.path = path
+        self.fsync = fsync
+        self.key = hashlib.sha256(
+            json.dumps(join_id, sort_keys=True).encode('utf-8')).hexdigest()
+        self.completed = {}
+        self.lock = threading.Lock()
+        
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last record may be incomplete after a crash
+                        continue
+                    if record['join'] == self.key:
+                        pair = (record['block_1'], record['block_2'])
+                        self.completed[pair] = (
+                            record['stats'], record['results'])
+        
+        print(f'Loaded {len(self.completed)} completed pairs from {path}')
+        self.file = open(path, 'a+')
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() > 0:
+            self.file.seek(self.file.tell() - 1)
+            if self.file.read(1) != '\n':
+                self.file.write('\n')
+    
+    def lookup(self, idx_1, idx_2):
+        """ Retrieves statistics and results for a completed block pair.
+        
+        Args:
+            idx_1: index of block from first table.
+            idx_2: index of block from second table.
+        
+        Returns:
+            statistics, results (or None if pair was not completed).
+        """
+        return self.completed.get((idx_1, idx_2))
+    
+    def record(self, idx_1, idx_2, stats, results):
+        """ Appends record for completed block pair to log.
+        
+        Args:
+            idx_1: index of block from first table.
+            idx_2: index of block from second table.
+            stats: statistics of join between the two blocks.
+            results: join results for the two blocks.
+        """
+        record = {
+            'join':self.key, 'block_1':idx_1, 'block_2':idx_2,
+            'stats':stats, 'results':results}
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.completed[(idx_1, idx_2)] = (stats, results)
+            self.file.write(line)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+    
+    def close(self):
+        """ Closes log file. """
+        self.file.close()
@@ -4,8 +4,22 @@ Created on Oct 16, 2024
 @author: immanueltrummer
 '''
 import numpy as np
+import os
 import time
 
+from llmjoin.real.backend import get_backend
+from llmjoin.real.cache import embedding_key
+from llmjoin.real.cache import fingerprint
+from llmjoin.real.streaming import collect
+from llmjoin.real.tokens import get_counter
+from llmjoin.real.vector_index import build_index
+from llmjoin.real.vector_index import load_index
+from llmjoin.real.vector_index import normalize
+from llmjoin.real.vector_index import save_index
+
+
+counter = get_counter('text-embedding-3-small')
+
 
 def cosine_similarity(embedding_1, embedding_2):
     """ Calculate cosine similarity between embedding vectors.
@@ -21,69 +35,243 @@ def cosine_similarity(embedding_1, embedding_2):
         np.linalg.norm(embedding_1) * np.linalg.norm(embedding_2))
 
 
-def embed(client, row):
+def split_tokens(total, counts):
+    """ Split token usage of a batch over its inputs.
+    
+    Args:
+        total: number of tokens reported for the batch.
+        counts: token counts of inputs according to local encoder.
+    
+    Returns:
+        list of token counts per input, summing up to total.
+    """
+    nr_counted = sum(counts)
+    if nr_counted == 0:
+        shares = [total / len(counts)] * len(counts)
+    else:
+        shares = [total * c / nr_counted for c in counts]
+    
+    split = [int(share) for share in shares]
+    remainders = sorted(
+        range(len(counts)), key=lambda i:split[i] - shares[i])
+    for i in remainders[:total - sum(split)]:
+        split[i] += 1
+    return split
+
+
+def embed_batch(
+        client, texts, cache=None, batch_size=256, max_batch_tokens=100000):
+    """ Generate embeddings for texts, sending multiple texts per request.
+    
+    Args:
+        client: OpenAI client or backend.
+        texts: list of texts to embed.
+        cache: optional cache for embeddings.
+        batch_size: maximal number of texts per request.
+        max_batch_tokens: maximal number of tokens per request.
+    
+    Returns:
+        list of embedding vectors, list of statistics per text.
+    """
+    model = 'text-embedding-3-small'
+    texts = [text.replace('\n', ' ') for text in texts]
+    embeddings = [None] * len(texts)
+    stats = [None] * len(texts)
+    
+    missing = []
+    for text_idx, text in enumerate(texts):
+        start_s = time.time()
+        key = embedding_key(model, text)
+        cached = None if cache is None else cache.lookup(key)
+        if cached is None:
+            missing.append(text_idx)
+        else:
+            embeddings[text_idx] = cached['embedding']
+            stats[text_idx] = {
+                'tokens_read':0, 
+                'tokens_written':0,
+                'seconds':time.time() - start_s,
+                'cache_hits':1,
+                'cache_misses':0}
+    
+    batches = []
+    batch = []
+    batch_tokens = 0
+    missing_counts = counter.count_batch([texts[idx] for idx in missing])
+    for text_idx, nr_tokens in zip(missing, missing_counts):
+        if batch and (
+            len(batch) >= batch_size or 
+            batch_tokens + nr_tokens > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append((text_idx, nr_tokens))
+        batch_tokens += nr_tokens
+    if batch:
+        batches.append(batch)
+    
+    backend = get_backend(client)
+    for batch in batches:
+        start_s = time.time()
+        batch_texts = [texts[text_idx] for text_idx, _ in batch]
+        batch_embeddings, batch_tokens = backend.embed(batch_texts, model)
+        counts = [nr_tokens for _, nr_tokens in batch]
+        tokens_read = split_tokens(batch_tokens, counts)
+        row_s = (time.time() - start_s) / len(batch)
+        for (text_idx, _), embedding, row_tokens in zip(
+            batch, batch_embeddings, tokens_read):
+            embeddings[text_idx] = embedding
+            stats[text_idx] = {
+                'tokens_read':row_tokens, 
+                'tokens_written':0,
+                'seconds':row_s,
+                'cache_hits':0,
+                'cache_misses':int(cache is not None)}
+            if cache is not None:
+                key = embedding_key(model, texts[text_idx])
+                cache.store(key, {'embedding':embedding})
+    
+    return embeddings, stats
+
+
+def embed(client, row, cache=None):
     """ Generate embedding for input row.
     
     Args:
-        client: OpenAI client.
+        client: OpenAI client or backend.
         row: table row to embed.
+        cache: optional cache for embeddings.
+    
+    Returns:
+        embedding vector, tokens read, whether embedding was cached
+    """
+    embeddings, stats = embed_batch(client, [row['text']], cache)
+    stat = stats[0]
+    return embeddings[0], stat['tokens_read'], stat['cache_hits'] == 1
+
+
+def index_table(
+        client, texts, cache=None, batch_size=256, max_batch_tokens=100000, 
+        index='exact', index_path=None):
+    """ Embeds texts and indexes their embeddings.
+    
+    If an index path is specified, the index is loaded from disk if it
+    was built for the same texts (otherwise, a new index is built and
+    stored at that path).
+    
+    Args:
+        client: OpenAI client or backend.
+        texts: list of texts to index.
+        cache: optional cache for embeddings.
+        batch_size: maximal number of texts per embedding request.
+        max_batch_tokens: maximal number of tokens per embedding request.
+        index: type of index ("exact" or "ivf").
+        index_path: optional path for storing index (.npz format).
     
     Returns:
-        embedding vector, tokens read
+        index, statistics of embedding requests.
     """
-    text = row['text']
-    text = text.replace('\n', ' ')
-    response = client.embeddings.create(
-        input=[text], model='text-embedding-3-small')
-    embedding = response.data[0].embedding
-    tokens_read = response.usage.prompt_tokens
-    return embedding, tokens_read
+    data_id = fingerprint(texts)
+    if index_path is not None and os.path.exists(index_path):
+        table_index = load_index(index_path)
+        if table_index.kind == index and table_index.fingerprint == data_id:
+            return table_index, []
+        print(f'Index at {index_path} does not match - rebuilding')
+    
+    embeddings, stats = embed_batch(
+        client, texts, cache, batch_size, max_batch_tokens)
+    table_index = build_index(index, normalize(embeddings), data_id)
+    if index_path is not None:
+        save_index(table_index, index_path)
+    return table_index, stats
 
+
+def embedding_join_stream(
+        client, df1, df2, predicate, model, 
+        cache=None, k=1, chunk_size=1024, 
+        batch_size=256, max_batch_tokens=100000, 
+        index='exact', index_path=None, nr_probes=None):
+    """ Perform embedding join, producing results for each embedded row.
     
-def embedding_join(client, df1, df2, predicate, model):
-    """ Perform tuple join.
+    Each row of the first table is matched with the k rows of the second
+    table whose embeddings are most similar. Similarities are calculated
+    for chunks of rows from the first table to bound memory consumption.
+    Embeddings of the second table are indexed, using either an exact or
+    an approximate index (see index_table for index persistence).
     
     Args:
-        client: OpenAI client.
+        client: OpenAI client or backend.
         df1: first input table.
         df2: second input table.
         predicate: join predicate.
         model: name of OpenAI model.
+        cache: optional cache for embeddings.
+        k: number of matches per row of first table.
+        chunk_size: number of rows from first table per matrix multiply.
+        batch_size: maximal number of texts per embedding request.
+        max_batch_tokens: maximal number of tokens per embedding request.
+        index: type of index for second table ("exact" or "ivf").
+        index_path: optional path for storing index (.npz format).
+        nr_probes: number of clusters searched by approximate index.
     
     Returns:
-        Tuple: statistics, join result.
+        A generator over (statistics, join result) per embedded row.
     """
-    results = []
-    stats = []    
-
-    embedding_row = []
-    for _, row2 in df2.iterrows():
-        start_s = time.time()
-        embedding, tokens_read = embed(client, row2)
-        embedding_row.append((embedding, row2))
-        total_s = time.time() - start_s
-        stats += [
-            {'tokens_read':tokens_read, 
-            'tokens_written':0,
-            'seconds':total_s}]
-
-    for _, row1 in df1.iterrows():
-        embedding_1, tokens_read = embed(client, row1)
-        start_s = time.time()
-        embedding_row.sort(
-            key=lambda embedding_2_tuple:cosine_similarity(
-                embedding_1, embedding_2_tuple[0]), 
-            reverse=True)
-        
-        row2 = embedding_row[0][1]
-        tuple_1 = row1['text']
-        tuple_2 = row2['text']
-        results += [{'tuple1':tuple_1, 'tuple2':tuple_2}]
+    tuples_1 = list(df1['text'])
+    tuples_2 = list(df2['text'])
+    table_index, stats = index_table(
+        client, tuples_2, cache, batch_size, max_batch_tokens, 
+        index, index_path)
+    for stat in stats:
+        yield stat, []
+    
+    for start in range(0, len(tuples_1), chunk_size):
+        chunk = tuples_1[start:start+chunk_size]
+        embeddings_1, chunk_stats = embed_batch(
+            client, chunk, cache, batch_size, max_batch_tokens)
         
-        total_s = time.time() - start_s
-        stats += [
-            {'tokens_read':tokens_read, 
-            'tokens_written':0,
-            'seconds':total_s}]
+        start_s = time.time()
+        indexes, _ = table_index.search(
+            normalize(embeddings_1), k, nr_probes)
+        row_s = (time.time() - start_s) / len(chunk)
+        for tuple_1, row_indexes, stat in zip(chunk, indexes, chunk_stats):
+            results = []
+            for idx_2 in row_indexes:
+                if idx_2 >= 0:
+                    tuple_2 = tuples_2[idx_2]
+                    results += [{'tuple1':tuple_1, 'tuple2':tuple_2}]
+            
+            stat['seconds'] += row_s
+            yield stat, results
 
-    return stats, results
\ No newline at end of file
+
+def embedding_join(
+        client, df1, df2, predicate, model, 
+        cache=None, k=1, chunk_size=1024, 
+        batch_size=256, max_batch_tokens=100000, 
+        index='exact', index_path=None, nr_probes=None):
+    """ Perform embedding join.
+    
+    Args:
+        client: OpenAI client or backend.
+        df1: first input table.
+        df2: second input table.
+        predicate: join predicate.
+        model: name of OpenAI model.
+        cache: optional cache for embeddings.
+        k: number of matches per row of first table.
+        chunk_size: number of rows from first table per matrix multiply.
+        batch_size: maximal number of texts per embedding request.
+        max_batch_tokens: maximal number of tokens per embedding request.
+        index: type of index for second table ("exact" or "ivf").
+        index_path: optional path for storing index (.npz format).
+        nr_probes: number of clusters searched by approximate index.
+    
+    Returns:
+        Tuple: statistics, join result.
+    """
+    return collect(embedding_join_stream(
+        client, df1, df2, predicate, model, cache=cache, k=k,
+        chunk_size=chunk_size, batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens, index=index,
+        index_path=index_path, nr_probes=nr_probes))
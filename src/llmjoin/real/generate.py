@@ -5,10 +5,11 @@ Created on Feb 24, 2024
 '''
 import dataclasses
 import pandas
-import tiktoken
 import typing
 
-encoder = tiktoken.encoding_for_model('gpt-4')
+from llmjoin.real.tokens import get_counter
+
+counter = get_counter('gpt-4')
 
 
 def inconsistency_benchmark(names, variant):
@@ -72,25 +73,27 @@ def inconsistency_benchmarks():
 def movie_benchmarks():
     """ Generates benchmarks focused on matching reviews. """
     
-    def shorten_review(review):
+    def shorten_review(review, tokens):
         """ Shortens review if above 100 tokens.
         
         Args:
             review: shortens this review.
+            tokens: encoded review.
         
         Returns:
             Shortened review.
         """
-        tokens = encoder.encode(review)
         nr_tokens = len(tokens)
         if nr_tokens > 100:
-            return encoder.decode(tokens[:100]) + ' ...'
+            return counter.encoder.decode(tokens[:100]) + ' ...'
         else:
             return review
     
     all_reviews = pandas.read_csv('testdata/all_reviews.csv')
-    all_reviews['text'] = all_reviews.apply(
-        lambda r:shorten_review(r['text']), axis=1)
+    reviews = list(all_reviews['text'])
+    all_reviews['text'] = [
+        shorten_review(review, tokens) for review, tokens in zip(
+            reviews, counter.encode_batch(reviews))]
     reviews_1 = all_reviews.iloc[:50]
     reviews_2 = all_reviews.iloc[50:]
     
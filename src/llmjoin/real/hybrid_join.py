@@ -0,0 +1,353 @@
+'''
+Created on Oct 17, 2026
+
+@author: immanueltrummer
+'''
+import contextlib
+
+from llmjoin.real.block_join import complete_prompt
+from llmjoin.real.block_join import find_indexes
+from llmjoin.real.block_join import t
+from llmjoin.real.block_join import token_size
+from llmjoin.real.embedding_join import embed_batch
+from llmjoin.real.embedding_join import index_table
+from llmjoin.real.scheduler import ordered_map
+from llmjoin.real.streaming import collect
+from llmjoin.real.vector_index import normalize
+
+
+def create_prompt(block_1, block_2, candidates, predicate):
+    """ Create prompt to verify candidate pairs using given predicate.
+    
+    Args:
+        block_1: entries from first table.
+        block_2: entries from second table.
+        candidates: list of candidate index pairs (starting from one).
+        predicate: join predicate as text.
+    
+    Returns:
+        a prompt for verifying candidate pairs.
+    """
+    parts = []
+    parts += [
+        ('Find candidate pairs x,y where x is the number of an entry in '
+         'collection 1 and y the number of an entry in collection 2 such '
+         f'that {predicate} (make sure to check all candidates!)!')]
+    parts += ['Separate index pairs by semicolons.']
+    parts += ['Write "Finished" after the last pair!']
+    parts += ['Text Collection 1:']
+    for idx, text in enumerate(block_1, 1):
+        parts += [f'{idx}: {text}']
+    parts += ['Text Collection 2:']
+    for idx, text in enumerate(block_2, 1):
+        parts += [f'{idx}: {text}']
+    candidate_text = ';'.join(f'{x},{y}' for x, y in candidates)
+    parts += [f'Candidate pairs: {candidate_text}']
+    parts += ['Index pairs:']
+    return '\n'.join(parts)
+
+
+def generate_candidates(
+        client, tuples_1, tuples_2, k, threshold, cache,
+        batch_size, max_batch_tokens, index, index_path, nr_probes,
+        chunk_size=1024):
+    """ Generate candidate pairs via embedding similarity.
+    
+    Args:
+        client: OpenAI client or backend.
+        tuples_1: entries of first table.
+        tuples_2: entries of second table.
+        k: number of candidates per entry of first table (None: no limit).
+        threshold: minimal similarity of candidates (None: no threshold).
+        cache: optional cache for embeddings.
+        batch_size: maximal number of texts per embedding request.
+        max_batch_tokens: maximal number of tokens per embedding request.
+        index: type of index for second table ("exact" or "ivf").
+        index_path: optional path for storing index (.npz format).
+        nr_probes: number of clusters searched by approximate index.
+        chunk_size: number of entries from first table searched at once.
+    
+    Returns:
+        list of candidate index pairs, statistics of embedding requests.
+    """
+    table_index, stats = index_table(
+        client, tuples_2, cache, batch_size, max_batch_tokens,
+        index, index_path)
+    k = len(tuples_2) if k is None else k
+    
+    candidates = []
+    for start in range(0, len(tuples_1), chunk_size):
+        chunk = tuples_1[start:start+chunk_size]
+        embeddings, chunk_stats = embed_batch(
+            client, chunk, cache, batch_size, max_batch_tokens)
+        stats += chunk_stats
+        indexes, similarities = table_index.search(
+            normalize(embeddings), k, nr_probes)
+        for chunk_idx, (row_indexes, row_similarities) in enumerate(
+            zip(indexes, similarities)):
+            for idx_2, similarity in zip(row_indexes, row_similarities):
+                if idx_2 >= 0 and (
+                    threshold is None or similarity >= threshold):
+                    candidates.append((start+chunk_idx, int(idx_2)))
+    
+    return candidates, stats
+
+
+def pack_candidates(candidates, tuples_1, tuples_2, predicate, s3=4):
+    """ Pack candidate pairs into verification prompts.
+    
+    Candidates are added to a prompt until the prompt, together with the
+    maximal answer size, would exceed the token limit. Entries appearing
+    in multiple candidates of the same prompt are listed only once.
+    
+    Args:
+        candidates: list of candidate index pairs (sorted by first index).
+        tuples_1: entries of first table.
+        tuples_2: entries of second table.
+        predicate: join predicate as text.
+        s3: number of tokens per index pair.
+    
+    Returns:
+        list of batches (each batch is a list of candidate pairs).
+    """
+    p = token_size(create_prompt([], [], [], predicate))
+    sizes_1 = {}
+    sizes_2 = {}
+    batches = []
+    batch = []
+    batch_1 = set()
+    batch_2 = set()
+    nr_tokens = p
+    for idx_1, idx_2 in candidates:
+        
+        # Listing candidate and answering both take about s3 tokens
+        extra_tokens = 2 * s3
+        if idx_1 not in sizes_1:
+            sizes_1[idx_1] = token_size(tuples_1[idx_1]) + s3
+        if idx_2 not in sizes_2:
+            sizes_2[idx_2] = token_size(tuples_2[idx_2]) + s3
+        if idx_1 not in batch_1:
+            extra_tokens += sizes_1[idx_1]
+        if idx_2 not in batch_2:
+            extra_tokens += sizes_2[idx_2]
+        
+        if batch and nr_tokens + extra_tokens > t:
+            batches.append(batch)
+            batch = []
+            batch_1 = set()
+            batch_2 = set()
+            nr_tokens = p + 2 * s3 + sizes_1[idx_1] + sizes_2[idx_2]
+        else:
+            nr_tokens += extra_tokens
+        batch.append((idx_1, idx_2))
+        batch_1.add(idx_1)
+        batch_2.add(idx_2)
+    
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def verify_prompt(
+        client, batch, tuples_1, tuples_2, predicate, model,
+        limiter=None, cache=None):
+    """ Verify candidate pairs via one LLM invocation.
+    
+    Args:
+        client: OpenAI client or backend.
+        batch: list of candidate index pairs.
+        tuples_1: entries of first table.
+        tuples_2: entries of second table.
+        predicate: join predicate as text.
+        model: name of OpenAI model to use.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+    
+    Returns:
+        Statistics, list of confirmed candidates (if the answer was
+        truncated, only candidates listed before the truncation).
+    """
+    indexes_1 = list(dict.fromkeys(idx_1 for idx_1, _ in batch))
+    indexes_2 = list(dict.fromkeys(idx_2 for _, idx_2 in batch))
+    positions_1 = {idx_1:pos for pos, idx_1 in enumerate(indexes_1, 1)}
+    positions_2 = {idx_2:pos for pos, idx_2 in enumerate(indexes_2, 1)}
+    block_1 = [tuples_1[idx_1] for idx_1 in indexes_1]
+    block_2 = [tuples_2[idx_2] for idx_2 in indexes_2]
+    local_candidates = [
+        (positions_1[idx_1], positions_2[idx_2]) for idx_1, idx_2 in batch]
+    
+    prompt = create_prompt(block_1, block_2, local_candidates, predicate)
+    stats, answer = complete_prompt(client, prompt, model, limiter, cache)
+    pairs = find_indexes(
+        answer, len(block_1), len(block_2), complete=not stats['overflow'])
+    confirmed = set((indexes_1[x], indexes_2[y]) for x, y in pairs)
+    return stats, [pair for pair in batch if pair in confirmed]
+
+
+def verify_candidates(
+        client, batch, tuples_1, tuples_2, predicate, model,
+        limiter=None, cache=None):
+    """ Verify one batch of candidate pairs via the LLM.
+    
+    If the answer is truncated, candidates confirmed before the
+    truncation are kept and the remaining candidates are split into
+    halves and verified recursively (as in join_with_recovery). The
+    batch is marked as overflowing only if a single candidate cannot
+    be verified within the token limit.
+    
+    Args:
+        client: OpenAI client or backend.
+        batch: list of candidate index pairs.
+        tuples_1: entries of first table.
+        tuples_2: entries of second table.
+        predicate: join predicate as text.
+        model: name of OpenAI model to use.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+    
+    Returns:
+        Statistics (summed over invocations), join result.
+    """
+    stats = {
+        'tokens_read':0, 'tokens_written':0, 'cached_tokens':0, 
+        'seconds':0, 'overflow':False, 'cache_hits':0, 'cache_misses':0,
+        'invocations':0, 'recoveries':0}
+    confirmed = []
+    todo = [batch]
+    while todo:
+        sub_batch = todo.pop()
+        sub_stats, sub_confirmed = verify_prompt(
+            client, sub_batch, tuples_1, tuples_2, 
+            predicate, model, limiter, cache)
+        for key, value in sub_stats.items():
+            if key != 'overflow':
+                stats[key] += value
+        stats['invocations'] += 1
+        confirmed += sub_confirmed
+        
+        if sub_stats['overflow']:
+            sub_confirmed = set(sub_confirmed)
+            remaining = [
+                pair for pair in sub_batch if pair not in sub_confirmed]
+            if len(remaining) > 1:
+                middle = len(remaining) // 2
+                todo += [remaining[middle:], remaining[:middle]]
+                stats['recoveries'] += 1
+            elif remaining:
+                print('Cannot split overflowing candidate batch further!')
+                stats['overflow'] = True
+    
+    stats['nr_candidates'] = len(batch)
+    confirmed = set(confirmed)
+    results = [
+        {'tuple1':tuples_1[idx_1], 'tuple2':tuples_2[idx_2]} 
+        for idx_1, idx_2 in batch if (idx_1, idx_2) in confirmed]
+    return stats, results
+
+
+def hybrid_join_stream(
+        client, df1, df2, predicate, model,
+        k=10, threshold=None, parallelism=1, limiter=None, cache=None,
+        batch_size=256, max_batch_tokens=100000,
+        index='exact', index_path=None, nr_probes=None):
+    """ Join via embedding-based candidate generation and LLM verification.
+    
+    For each entry of the first table, the most similar entries of the
+    second table (according to embeddings) become candidates. Candidates
+    are verified by the LLM, packing many candidates into each prompt.
+    Results are produced as soon as each verification prompt completes.
+    Batches with truncated answers are split (see verify_candidates) and
+    the join stops if a single candidate cannot be verified.
+    
+    Args:
+        client: OpenAI client or backend.
+        df1: first input table.
+        df2: second input table.
+        predicate: join predicate as text.
+        model: name of OpenAI model to use.
+        k: number of candidates per entry of first table (None: no limit).
+        threshold: minimal similarity of candidates (None: no threshold).
+        parallelism: maximal number of concurrent LLM invocations.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses and embeddings.
+        batch_size: maximal number of texts per embedding request.
+        max_batch_tokens: maximal number of tokens per embedding request.
+        index: type of index for second table ("exact" or "ivf").
+        index_path: optional path for storing index (.npz format).
+        nr_probes: number of clusters searched by approximate index.
+    
+    Returns:
+        A generator over (statistics, join result) per invocation.
+    """
+    tuples_1 = list(df1['text'])
+    tuples_2 = list(df2['text'])
+    candidates, embed_stats = generate_candidates(
+        client, tuples_1, tuples_2, k, threshold, cache,
+        batch_size, max_batch_tokens, index, index_path, nr_probes)
+    
+    nr_pairs = len(tuples_1) * len(tuples_2)
+    candidate_ratio = len(candidates) / nr_pairs if nr_pairs else 0
+    print(
+        f'Verifying {len(candidates)} out of {nr_pairs} pairs '
+        f'(reduction ratio: {candidate_ratio}) ...')
+    for stat in embed_stats:
+        stat['overflow'] = None
+        stat['nr_candidates'] = 0
+        stat['candidate_ratio'] = candidate_ratio
+        yield stat, []
+    
+    def verify_batch(batch):
+        """ Verifies one batch of candidates.
+        
+        Args:
+            batch: list of candidate index pairs.
+        
+        Returns:
+            Statistics, join result.
+        """
+        return verify_candidates(
+            client, batch, tuples_1, tuples_2,
+            predicate, model, limiter, cache)
+    
+    batches = pack_candidates(candidates, tuples_1, tuples_2, predicate)
+    with contextlib.closing(
+        ordered_map(verify_batch, batches, parallelism)) as batch_results:
+        for stat, result in batch_results:
+            stat['candidate_ratio'] = candidate_ratio
+            yield stat, result
+            if stat['overflow']:
+                break
+
+
+def hybrid_join(
+        client, df1, df2, predicate, model,
+        k=10, threshold=None, parallelism=1, limiter=None, cache=None,
+        batch_size=256, max_batch_tokens=100000,
+        index='exact', index_path=None, nr_probes=None):
+    """ Join via embedding-based candidate generation and LLM verification.
+    
+    Args:
+        client: OpenAI client or backend.
+        df1: first input table.
+        df2: second input table.
+        predicate: join predicate as text.
+        model: name of OpenAI model to use.
+        k: number of candidates per entry of first table (None: no limit).
+        threshold: minimal similarity of candidates (None: no threshold).
+        parallelism: maximal number of concurrent LLM invocations.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses and embeddings.
+        batch_size: maximal number of texts per embedding request.
+        max_batch_tokens: maximal number of tokens per embedding request.
+        index: type of index for second table ("exact" or "ivf").
+        index_path: optional path for storing index (.npz format).
+        nr_probes: number of clusters searched by approximate index.
+    
+    Returns:
+        A tuple: (performance statistics, join result).
+    """
+    return collect(hybrid_join_stream(
+        client, df1, df2, predicate, model, k=k, threshold=threshold,
+        parallelism=parallelism, limiter=limiter, cache=cache,
+        batch_size=batch_size, max_batch_tokens=max_batch_tokens,
+        index=index, index_path=index_path, nr_probes=nr_probes))
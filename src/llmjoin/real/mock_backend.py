@@ -0,0 +1,313 @@
+'''
+Created on Oct 17, 2026
+
+@author: immanueltrummer
+'''
+import collections
+import hashlib
+import numpy as np
+import random
+import re
+import threading
+import time
+
+from llmjoin.real.block_join import encoder
+from llmjoin.real.block_join import format_answer
+from llmjoin.real.block_join import index_label
+
+
+class MockServerError(Exception):
+    """ Error returned by mock backend (e.g., injected failure). """
+    pass
+
+
+class MockRateLimitError(MockServerError):
+    """ Request rejected since it exceeds the mock's rate limits. """
+    pass
+
+
+def text_seed(text):
+    """ Derives deterministic random seed from text.
+    
+    Args:
+        text: derive seed from this text.
+    
+    Returns:
+        an integer seed.
+    """
+    return int(hashlib.sha256(text.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def parse_entries(section, encoding='verbose'):
+    """ Extracts labeled entries ("1: text") from a prompt section.
+    
+    Args:
+        section: part of prompt listing entries in order.
+        encoding: prompt encoding (determines labels).
+    
+    Returns:
+        list of entry texts.
+    """
+    entries = []
+    position = 0
+    idx = 1
+    while section.startswith(f'{index_label(idx, encoding)}: ', position):
+        start = position + len(f'{index_label(idx, encoding)}: ')
+        end = section.find(f'\n{index_label(idx+1, encoding)}: ', start)
+        if end == -1:
+            entries.append(section[start:])
+            break
+        entries.append(section[start:end])
+        position = end + 1
+        idx += 1
+    return entries
+
+
+class MockBackend():
+    """ Local stand-in for language models, answering from ground truth.
+    
+    Block prompts (including candidate and continuation prompts) and
+    tuple prompts are answered according to a reference result. Texts
+    that match according to the reference obtain similar embeddings.
+    Latency, rate limits, concurrency, and failures are configurable.
+    Optionally, prompt caching is simulated: prompt prefixes shared with
+    recent prompts count as cached and do not add prefill latency.
+    """
+    
+    def __init__(
+            self, reference, overhead=0, prefill_rate=None,
+            generation_rate=None, max_concurrency=None,
+            requests_per_minute=None, tokens_per_minute=None,
+            error_rate=0, seed=0, dimensions=64,
+            prefix_cache_size=0, min_cached_tokens=1024):
+        """ Initializes mock backend.
+        
+        Args:
+            reference: data frame with columns text1, text2, and joins.
+            overhead: seconds of latency per request.
+            prefill_rate: tokens read per second (None: no delay).
+            generation_rate: tokens generated per second (None: no delay).
+            max_concurrency: maximal number of requests served at once.
+            requests_per_minute: reject requests beyond this rate.
+            tokens_per_minute: reject requests beyond this token rate.
+            error_rate: probability that a request fails.
+            seed: seed for error injection.
+            dimensions: number of embedding dimensions.
+            prefix_cache_size: number of recent prompts kept for caching.
+            min_cached_tokens: minimal length of cached prefixes.
+        """
+        matches = reference[reference['joins'].astype(bool)]
+        self.matches = set(zip(matches['text1'], matches['text2']))
+        self.overhead = overhead
+        self.prefill_rate = prefill_rate
+        self.generation_rate = generation_rate
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.dimensions = dimensions
+        self.prefixes = collections.deque(maxlen=prefix_cache_size)
+        self.min_cached_tokens = min_cached_tokens
+        self.lock = threading.Lock()
+        self.window = collections.deque()
+        self.window_tokens = 0
+        self.slots = None if max_concurrency is None else \
+            threading.BoundedSemaphore(max_concurrency)
+        
+        # Matching texts share clusters (and similar embeddings)
+        self.clusters = {}
+        for text_1, text_2 in self.matches:
+            cluster_1 = self._cluster(text_1)
+            cluster_2 = self._cluster(text_2)
+            self.clusters[cluster_2] = cluster_1
+    
+    def _cluster(self, text):
+        """ Finds cluster representative of text.
+        
+        Args:
+            text: find cluster of this text.
+        
+        Returns:
+            text representing cluster.
+        """
+        text = text.replace('\n', ' ')
+        while self.clusters.get(text, text) != text:
+            text = self.clusters[text]
+        return text
+    
+    def _admit(self, tokens):
+        """ Checks whether request fails or exceeds rate limits.
+        
+        Args:
+            tokens: number of tokens read by request.
+        """
+        with self.lock:
+            if self.random.random() < self.error_rate:
+                raise MockServerError('Injected server error!')
+            
+            now = time.time()
+            while self.window and self.window[0][0] <= now - 60:
+                _, old_tokens = self.window.popleft()
+                self.window_tokens -= old_tokens
+            if self.requests_per_minute is not None and \
+                len(self.window) >= self.requests_per_minute:
+                raise MockRateLimitError('Too many requests!')
+            if self.tokens_per_minute is not None and \
+                self.window_tokens + tokens > self.tokens_per_minute:
+                raise MockRateLimitError('Too many tokens!')
+            self.window.append((now, tokens))
+            self.window_tokens += tokens
+    
+    def _cached(self, prompt_tokens):
+        """ Determines prompt tokens served from simulated prompt cache.
+        
+        Args:
+            prompt_tokens: tokens of prompt (added to the cache).
+        
+        Returns:
+            number of tokens in longest prefix shared with recent prompts.
+        """
+        if self.prefixes.maxlen == 0:
+            return 0
+        
+        with self.lock:
+            cached = 0
+            for prefix in self.prefixes:
+                shared = 0
+                for token_1, token_2 in zip(prefix, prompt_tokens):
+                    if token_1 != token_2:
+                        break
+                    shared += 1
+                cached = max(cached, shared)
+            self.prefixes.append(prompt_tokens)
+        
+        return cached if cached >= self.min_cached_tokens else 0
+    
+    def _wait(self, tokens_read, tokens_written):
+        """ Simulates latency of a request.
+        
+        Args:
+            tokens_read: number of tokens read.
+            tokens_written: number of tokens generated.
+        """
+        seconds = self.overhead
+        if self.prefill_rate is not None:
+            seconds += tokens_read / self.prefill_rate
+        if self.generation_rate is not None:
+            seconds += tokens_written / self.generation_rate
+        if self.slots is None:
+            time.sleep(seconds)
+        else:
+            with self.slots:
+                time.sleep(seconds)
+    
+    def _answer(self, prompt):
+        """ Generates complete answer to prompt according to ground truth.
+        
+        Args:
+            prompt: block prompt or tuple prompt.
+        
+        Returns:
+            answer text.
+        """
+        if 'Text Collection 1:\n' in prompt or '\nA:\n' in prompt:
+            if 'Text Collection 1:\n' in prompt:
+                encoding = 'verbose'
+                header_1, header_2 = 'Text Collection 1:', 'Text Collection 2:'
+            else:
+                encoding = 'grouped' if '(group by x)' in prompt \
+                    else 'compact'
+                header_1, header_2 = 'A:', 'B:'
+            end = r'\n(?:Candidate pairs: |Index pairs:|Pairs:|Pairs up to ' \
+                r'|List only pairs after )'
+            rest_1 = prompt.split(f'\n{header_1}\n', 1)[1]
+            rest_2 = prompt.split(f'\n{header_2}\n', 1)[1]
+            section_1 = re.split(f'\n{header_2}\n|{end}', rest_1)[0]
+            section_2 = re.split(f'\n{header_1}\n|{end}', rest_2)[0]
+            block_1 = parse_entries(section_1, encoding)
+            block_2 = parse_entries(section_2, encoding)
+            pairs = [
+                (x, y) for x, text_1 in enumerate(block_1, 1)
+                for y, text_2 in enumerate(block_2, 1)
+                if (text_1, text_2) in self.matches]
+            candidates = re.search(r'\nCandidate pairs: ([\d,;]*)', prompt)
+            if candidates is not None:
+                allowed = set(
+                    tuple(int(i) for i in pair.split(','))
+                    for pair in candidates.group(1).split(';') if pair)
+                pairs = [pair for pair in pairs if pair in allowed]
+            after = re.search(
+                r'(?:starting|pairs) after (\w+),(\w+)', prompt)
+            if after is not None:
+                base = 10 if encoding == 'verbose' else 36
+                last_pair = (
+                    int(after.group(1), base), int(after.group(2), base))
+                pairs = [pair for pair in pairs if pair > last_pair]
+            return format_answer(pairs, encoding)
+        
+        text_1 = re.search(r'\nText 1: (.*)\nText 2: ', prompt, re.DOTALL)
+        text_2 = re.search(r'\nText 2: (.*)\nAnswer:', prompt, re.DOTALL)
+        if text_1 is None or text_2 is None:
+            raise MockServerError('Unknown prompt format!')
+        pair = (text_1.group(1), text_2.group(1))
+        return 'Yes' if pair in self.matches else 'No'
+    
+    def complete(self, prompt, model, max_tokens, stop=None, on_chunk=None):
+        """ Generates answer to prompt, truncated at max_tokens.
+        
+        Args:
+            prompt: prompt text.
+            model: name of model (ignored).
+            max_tokens: maximal number of tokens to generate.
+            stop: optional list of stop sequences (ignored).
+            on_chunk: optional function called on each answer token.
+        
+        Returns:
+            dictionary with answer, finish_reason, tokens_read,
+            tokens_written, and cached_tokens.
+        """
+        prompt_tokens = encoder.encode(prompt)
+        tokens_read = len(prompt_tokens)
+        self._admit(tokens_read)
+        cached_tokens = self._cached(prompt_tokens)
+        answer_tokens = encoder.encode(self._answer(prompt))
+        finish_reason = 'stop'
+        if len(answer_tokens) > max_tokens:
+            answer_tokens = answer_tokens[:max_tokens]
+            finish_reason = 'length'
+        
+        self._wait(tokens_read - cached_tokens, len(answer_tokens))
+        if on_chunk is not None:
+            for token in answer_tokens:
+                on_chunk(encoder.decode([token]))
+        return {
+            'answer':encoder.decode(answer_tokens),
+            'finish_reason':finish_reason,
+            'tokens_read':tokens_read,
+            'tokens_written':len(answer_tokens),
+            'cached_tokens':cached_tokens}
+    
+    def embed(self, texts, model):
+        """ Calculates embeddings, similar for matching texts.
+        
+        Args:
+            texts: list of texts to embed.
+            model: name of embedding model (ignored).
+        
+        Returns:
+            list of embedding vectors, number of tokens read.
+        """
+        tokens_read = sum(len(encoder.encode(text)) for text in texts)
+        self._admit(tokens_read)
+        embeddings = []
+        for text in texts:
+            cluster = self._cluster(text)
+            center = np.random.default_rng(
+                text_seed(cluster)).normal(size=self.dimensions)
+            noise = np.random.default_rng(
+                text_seed(text)).normal(size=self.dimensions)
+            embedding = center + 0.3 * noise
+            embeddings.append(list(embedding / np.linalg.norm(embedding)))
+        
+        self._wait(tokens_read, 0)
+        return embeddings, tokens_read
@@ -0,0 +1,260 @@
+'''
+Created on Oct 17, 2026
+
+@author: immanueltrummer
+'''
+import math
+
+from llmjoin.real import tuple_join
+from llmjoin.real.adaptive_join import adaptive_join_stream
+from llmjoin.real.block_join import block_join_stream
+from llmjoin.real.block_join import create_prompt
+from llmjoin.real.block_join import estimate_selectivity
+from llmjoin.real.block_join import t
+from llmjoin.real.block_join import token_size
+from llmjoin.real.block_join import tuple_size
+from llmjoin.real.streaming import collect
+from llmjoin.real.tuple_join import tuple_join_stream
+from llmjoin.simulated.simulator import simulate_block_join
+from llmjoin.simulated.simulator import simulate_incremental_join
+from llmjoin.simulated.simulator import simulate_latency
+from llmjoin.simulated.simulator import simulate_tuple_join
+
+
+def probe_seconds(sample_stats, default=5.0):
+    """ Measures average latency of LLM invocations during sampling.
+    
+    Args:
+        sample_stats: statistics of sampled block pairs.
+        default: latency used if no invocation reached the LLM.
+    
+    Returns:
+        average number of seconds per LLM invocation.
+    """
+    seconds = [
+        stat['seconds'] for stat in sample_stats
+        if stat['tokens_read'] > 0]
+    return sum(seconds) / len(seconds) if seconds else default
+
+
+def estimate_plans(
+        r1, r2, s1, s2, s3, sigma, bound, g, p_tuple, p_block,
+        seconds_per_call, parallelism, initial_estimate=0.001, 
+        latency=None):
+    """ Estimates cost and latency of each join operator.
+    
+    Costs are calculated via the simulator's cost models (the adaptive
+    join is modeled by simulate_incremental_join). Latency is
+    estimated via the given latency model or, if none is given, by
+    assuming that invocations take equally long. In both cases, up
+    to parallelism invocations run at the same time.
+    
+    Args:
+        r1: number of rows in first table.
+        r2: number of rows in second table.
+        s1: average tuple size in first table.
+        s2: average tuple size in second table.
+        s3: size of join result tuples.
+        sigma: estimated selectivity of join predicate.
+        bound: upper bound on selectivity.
+        g: relative cost of written tokens.
+        p_tuple: size of static prompt parts for tuple join.
+        p_block: size of static prompt parts for block join.
+        seconds_per_call: average latency of one LLM invocation.
+        parallelism: maximal number of concurrent LLM invocations.
+        initial_estimate: initial selectivity estimate of adaptive join.
+        latency: optional latency model (see simulate_latency).
+    
+    Returns:
+        list of dictionaries describing operator, parameters, and costs.
+    """
+    tuple_result = simulate_tuple_join(r1, r2, s1, s2, s3, g, p_tuple)
+    block_result = simulate_block_join(
+        r1, r2, s1, s2, s3, sigma, bound, g, p_block, t, 'block')
+    adaptive_result = simulate_incremental_join(
+        r1, r2, s1, s2, s3, sigma, initial_estimate, g, p_block, t)
+    plans = [
+        {'operator':'tuple_join', 'parameters':{},
+         'invocations':tuple_result['tuple_invocations'],
+         'read':tuple_result['tuple_read'],
+         'written':tuple_result['tuple_written'],
+         'cost':tuple_result['tuple_cost']},
+        {'operator':'block_join', 'parameters':{'estimate':bound},
+         'invocations':block_result['block_block_invocations'],
+         'read':block_result['block_block_read'],
+         'written':block_result['block_block_written'],
+         'cost':block_result['block_block_cost']},
+        {'operator':'adaptive_join',
+         'parameters':{'estimate':initial_estimate},
+         'invocations':adaptive_result['incremental_invocations'],
+         'read':adaptive_result['incremental_read'],
+         'written':adaptive_result['incremental_written'],
+         'cost':adaptive_result['incremental_cost']}]
+    for plan in plans:
+        if latency is None:
+            rounds = math.ceil(plan['invocations'] / parallelism)
+            plan['seconds'] = rounds * seconds_per_call
+        else:
+            plan['seconds'] = float(simulate_latency(
+                plan['invocations'], plan['read'], plan['written'], 
+                latency | {'concurrency':parallelism}))
+    
+    return plans
+
+
+def choose_plan(plans, max_seconds=None):
+    """ Chooses cheapest plan that meets the latency limit.
+    
+    Args:
+        plans: list of plans with estimated cost and latency.
+        max_seconds: latency limit (None: no limit).
+    
+    Returns:
+        chosen plan (the fastest one if no plan meets the limit).
+    """
+    feasible = [
+        plan for plan in plans
+        if max_seconds is None or plan['seconds'] <= max_seconds]
+    if feasible:
+        return min(feasible, key=lambda p:(p['cost'], p['seconds']))
+    else:
+        return min(plans, key=lambda p:(p['seconds'], p['cost']))
+
+
+def explain_plan(plans, chosen, max_seconds=None):
+    """ Describes alternative plans and the reason for choosing one.
+    
+    Args:
+        plans: list of plans with estimated cost and latency.
+        chosen: the chosen plan.
+        max_seconds: latency limit (None: no limit).
+    
+    Returns:
+        explanation as text.
+    """
+    parts = []
+    for plan in plans:
+        parts += [
+            (f'{plan["operator"]} {plan["parameters"]}: '
+             f'{plan["invocations"]} invocations, '
+             f'cost {plan["cost"]:.0f}, {plan["seconds"]:.1f} seconds')]
+    if max_seconds is not None and chosen['seconds'] > max_seconds:
+        reason = f'no plan meets {max_seconds} seconds, choosing fastest'
+    elif max_seconds is not None:
+        reason = f'cheapest plan meeting {max_seconds} seconds'
+    else:
+        reason = 'cheapest plan'
+    parts += [f'Chosen: {chosen["operator"]} ({reason})']
+    return '\n'.join(parts)
+
+
+def plan_join(
+        client, df1, df2, predicate, model, g=2,
+        nr_probes=4, probe_size=5, confidence=0.95,
+        parallelism=1, limiter=None, cache=None, max_seconds=None,
+        profile=None):
+    """ Chooses join operator and parameters based on input statistics.
+    
+    Row counts and token sizes are measured on the input tables and
+    selectivity is estimated by joining sampled block pairs. Parameters
+    fitted to real runs (see calibrate) replace default sizes of result
+    tuples and prompts as well as the latency estimate.
+    
+    Args:
+        client: OpenAI client or backend.
+        df1: first input table.
+        df2: second input table.
+        predicate: join predicate as text.
+        model: name of OpenAI model to use.
+        g: relative cost of written tokens.
+        nr_probes: number of sampled block pairs for estimating selectivity.
+        probe_size: number of tuples per sampled block.
+        confidence: probability that selectivity is below bound.
+        parallelism: maximal number of concurrent LLM invocations.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        max_seconds: optional limit on estimated latency.
+        profile: optional parameter profile (see load_profile).
+    
+    Returns:
+        chosen plan, statistics of sampling invocations.
+    """
+    r1 = len(df1)
+    r2 = len(df2)
+    s1 = tuple_size(df1)
+    s2 = tuple_size(df2)
+    profile = {} if profile is None else profile
+    s3 = profile.get('s3', 4)
+    p_tuple = profile.get(
+        'p_tuple', token_size(tuple_join.create_prompt('', '', predicate)))
+    p_block = profile.get(
+        'p_block', token_size(create_prompt([], [], predicate)))
+    sigma, bound, _, sample_stats = estimate_selectivity(
+        client, df1, df2, predicate, model, nr_probes, probe_size,
+        confidence, parallelism=parallelism, limiter=limiter, cache=cache)
+    seconds_per_call = probe_seconds(sample_stats)
+    
+    plans = estimate_plans(
+        r1, r2, s1, s2, s3, sigma, bound, g, p_tuple, p_block,
+        seconds_per_call, parallelism, latency=profile.get('latency'))
+    chosen = choose_plan(plans, max_seconds)
+    chosen['explanation'] = explain_plan(plans, chosen, max_seconds)
+    chosen['sample_estimate'] = sigma
+    chosen['sample_bound'] = bound
+    return chosen, sample_stats
+
+
+def planned_join_stream(
+        client, df1, df2, predicate, model,
+        parallelism=1, limiter=None, cache=None, **kwargs):
+    """ Plans join and executes chosen operator.
+    
+    Args:
+        client: OpenAI client or backend.
+        df1: first input table.
+        df2: second input table.
+        predicate: join predicate as text.
+        model: name of OpenAI model to use.
+        parallelism: maximal number of concurrent LLM invocations.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        kwargs: further arguments for planning (see plan_join).
+    
+    Returns:
+        A generator over (statistics, join result) per LLM invocation.
+    """
+    plan, sample_stats = plan_join(
+        client, df1, df2, predicate, model, parallelism=parallelism,
+        limiter=limiter, cache=cache, **kwargs)
+    print(plan['explanation'])
+    
+    for stat in sample_stats:
+        yield stat | {'phase':'sample', 'operator':None}, []
+    
+    operators = {
+        'tuple_join':tuple_join_stream,
+        'block_join':block_join_stream,
+        'adaptive_join':adaptive_join_stream}
+    stream = operators[plan['operator']](
+        client, df1, df2, predicate, model, parallelism=parallelism,
+        limiter=limiter, cache=cache, **plan['parameters'])
+    for stat, result in stream:
+        yield stat | {'phase':'join', 'operator':plan['operator']}, result
+
+
+def planned_join(client, df1, df2, predicate, model, **kwargs):
+    """ Plans join and executes chosen operator.
+    
+    Args:
+        client: OpenAI client or backend.
+        df1: first input table.
+        df2: second input table.
+        predicate: join predicate as text.
+        model: name of OpenAI model to use.
+        kwargs: further arguments (see planned_join_stream).
+    
+    Returns:
+        A tuple: (performance statistics, join result).
+    """
+    return collect(planned_join_stream(
+        client, df1, df2, predicate, model, **kwargs))
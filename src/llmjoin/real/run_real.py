@@ -4,65 +4,88 @@ Created on Feb 25, 2024
 @author: immanueltrummer
 '''
 import argparse
-from llmjoin.real.adaptive_join import adaptive_join
-from llmjoin.real.block_join import block_join
-from llmjoin.real.embedding_join import embedding_join
-from llmjoin.real.tuple_join import tuple_join
+from llmjoin.real.adaptive_join import adaptive_join_stream
+from llmjoin.real.block_join import block_join_stream
+from llmjoin.real.cache import ResponseCache
+from llmjoin.real.embedding_join import embedding_join_stream
+from llmjoin.real.hybrid_join import hybrid_join_stream
+from llmjoin.real.mock_backend import MockBackend
+from llmjoin.real.planner import planned_join_stream
+from llmjoin.real.streaming import write_stream
+from llmjoin.real.tuple_join import tuple_join_stream
 import openai
 import pandas
 
 
-def run_benchmark(client, df1, df2, predicate, scenario):
+def run_benchmark(client, df1, df2, predicate, scenario, cache=None):
     """ Benchmark join algorithms in given scenario.
     
+    Statistics and results are written to disk as they arrive.
+    
     Args:
-        client: OpenAI client.
+        client: OpenAI client or backend.
         df1: left join input.
         df2: right join input.
         predicate: join predicate.
         scenario: scenario name (used in names of output files).
+        cache: optional cache for LLM responses.
     """
     named_ops = [
-        # (adaptive_join, 'adaptive_join'), 
-        #(block_join, 'block_join'),
-        (embedding_join, 'embedding_join'),
-        #(tuple_join, 'tuple_join'),
+        # (adaptive_join_stream, 'adaptive_join'), 
+        #(block_join_stream, 'block_join'),
+        (embedding_join_stream, 'embedding_join'),
+        #(hybrid_join_stream, 'hybrid_join'),
+        #(tuple_join_stream, 'tuple_join'),
+        #(planned_join_stream, 'planned_join'),
         ]
         
     for join_op, op_name in named_ops:
-        statistics, result = join_op(
+        stream = join_op(
             client, df1, df2, 
-            predicate, model)
-        
-        statistics = pandas.DataFrame(statistics)
-        result = pandas.DataFrame(result)
-        statistics.to_csv(f'testresults/{op_name}_{scenario}_stats.csv')
-        result.to_csv(f'testresults/{op_name}_{scenario}_results.csv')
+            predicate, model, cache=cache)
+        write_stream(
+            stream, 
+            f'testresults/{op_name}_{scenario}_stats.csv',
+            f'testresults/{op_name}_{scenario}_results.csv')
 
 
 if __name__ == '__main__':
     
     parser = argparse.ArgumentParser()
     parser.add_argument('ai_key', type=str, help='OpenAI access key')
+    parser.add_argument('--cache', type=str, help='Path to response cache')
+    parser.add_argument(
+        '--mock', action='store_true', 
+        help='Answer from reference results instead of calling OpenAI')
     args = parser.parse_args()
     
-    client = openai.OpenAI(api_key=args.ai_key, timeout=300)
+    if args.mock:
+        reference = pandas.concat([
+            pandas.read_csv(f'testdata/{ref_name}') for ref_name in [
+                'ad_matches_search.csv', 'same_reviews.csv', 
+                'inconsistencies.csv']])
+        client = MockBackend(reference)
+    else:
+        client = openai.OpenAI(api_key=args.ai_key, timeout=300)
     model = 'gpt-4'
+    cache = None if args.cache is None else ResponseCache(args.cache)
     
     ads = pandas.read_csv('testdata/ads.csv')
     searches = pandas.read_csv('testdata/searches.csv')
     predicate = 'the search matches the offer precisely'
-    run_benchmark(client, ads, searches, predicate, 'ad_matches')
+    run_benchmark(client, ads, searches, predicate, 'ad_matches', cache)
     
     reviews_1 = pandas.read_csv('testdata/reviews_1.csv')
     reviews_2 = pandas.read_csv('testdata/reviews_2.csv')
     predicate = 'both reviews are positive or both are negative'
-    run_benchmark(client, reviews_1, reviews_2, predicate, 'same_review')
+    run_benchmark(
+        client, reviews_1, reviews_2, predicate, 'same_review', cache)
     
     emails = pandas.read_csv('testdata/emails.csv')
     statements = pandas.read_csv('testdata/statements.csv')
     predicate = 'The two texts contradict each other'
-    run_benchmark(client, statements, emails, predicate, 'inconsistency')
+    run_benchmark(
+        client, statements, emails, predicate, 'inconsistency', cache)
     
     # for nr_names in [
         # 50,
@@ -0,0 +1,79 @@
+'''
+Created on Oct 17, 2026
+
+@author: immanueltrummer
+'''
+import math
+import random
+import statistics
+
+
+def upper_bound(nr_matches, nr_pairs, confidence):
+    """ Calculates upper confidence bound on selectivity (Wilson score).
+    
+    Args:
+        nr_matches: number of matching pairs in sample.
+        nr_pairs: number of pairs in sample.
+        confidence: probability that true selectivity is below the bound.
+    
+    Returns:
+        upper bound on selectivity.
+    """
+    if nr_pairs == 0:
+        return 1.0
+    
+    z = statistics.NormalDist().inv_cdf(confidence)
+    ratio = nr_matches / nr_pairs
+    center = ratio + z * z / (2 * nr_pairs)
+    spread = z * math.sqrt(
+        ratio * (1 - ratio) / nr_pairs + z * z / (4 * nr_pairs * nr_pairs))
+    return min(1.0, (center + spread) / (1 + z * z / nr_pairs))
+
+
+def sample_blocks(df1, df2, nr_probes, probe_size, seed=0, nr_regions=1):
+    """ Draw random samples of tuples for probing join selectivity.
+    
+    The first table is divided into consecutive regions of (almost)
+    equal size. Probes cycle over regions, sampling tuples of the first
+    table only from the corresponding region.
+    
+    Args:
+        df1: first input table.
+        df2: second input table.
+        nr_probes: number of samples to draw.
+        probe_size: number of tuples per table and sample.
+        seed: seed for sampling tuples.
+        nr_regions: number of regions in first table.
+    
+    Returns:
+        list of probes (region index and two blocks of strings).
+    """
+    generator = random.Random(seed)
+    tuples_1 = list(df1['text'])
+    tuples_2 = list(df2['text'])
+    probes = []
+    for probe_idx in range(nr_probes):
+        region = probe_idx % nr_regions
+        start, end = region_bounds(len(tuples_1), nr_regions, region)
+        region_tuples = tuples_1[start:end]
+        block_1 = generator.sample(
+            region_tuples, min(probe_size, len(region_tuples)))
+        block_2 = generator.sample(tuples_2, min(probe_size, len(tuples_2)))
+        probes.append((region, block_1, block_2))
+    return probes
+
+
+def region_bounds(nr_rows, nr_regions, region):
+    """ Calculates rows belonging to one region of a table.
+    
+    Args:
+        nr_rows: number of rows in table.
+        nr_regions: number of regions in table.
+        region: index of region.
+    
+    Returns:
+        index of first row, index after last row of region.
+    """
+    start = region * nr_rows // nr_regions
+    end = (region + 1) * nr_rows // nr_regions
+    return start, end
@@ -0,0 +1,90 @@
+'''
+Created on Oct 17, 2026
+
+@author: immanueltrummer
+'''
+import collections
+import concurrent.futures
+import threading
+import time
+
+
+class RateLimiter():
+    """ Enforces budgets on requests and tokens per minute. """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        """ Initializes rate limiter.
+
+        Args:
+            requests_per_minute: maximal number of requests (None: no limit).
+            tokens_per_minute: maximal number of tokens (None: no limit).
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = collections.deque()
+        self.window_tokens = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        """ Blocks until a request with given token count fits the budgets.
+
+        Args:
+            tokens: number of tokens consumed by the request.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                while self.window and self.window[0][0] <= now - 60:
+                    _, old_tokens = self.window.popleft()
+                    self.window_tokens -= old_tokens
+
+                fits_requests = self.requests_per_minute is None or \
+                    len(self.window) < self.requests_per_minute
+                fits_tokens = self.tokens_per_minute is None or \
+                    not self.window or \
+                    self.window_tokens + tokens <= self.tokens_per_minute
+                if fits_requests and fits_tokens:
+                    self.window.append((now, tokens))
+                    self.window_tokens += tokens
+                    return
+
+                wait_s = self.window[0][0] + 60 - now
+
+            time.sleep(max(wait_s, 0.01))
+
+
+def ordered_map(function, items, parallelism=1):
+    """ Applies function to items, keeping multiple calls in flight.
+
+    Results are yielded in the order of the input items, regardless of
+    the order in which calls complete. Calls that have not started yet
+    are cancelled once the generator is closed (e.g., when the caller
+    stops iterating).
+
+    Args:
+        function: apply this function to each item.
+        items: iterable over input items.
+        parallelism: maximal number of concurrent calls.
+
+    Returns:
+        generator over function results, in input order.
+    """
+    if parallelism <= 1:
+        for item in items:
+            yield function(item)
+        return
+
+    max_pending = 4 * parallelism
+    with concurrent.futures.ThreadPoolExecutor(parallelism) as executor:
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
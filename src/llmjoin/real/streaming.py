@@ -0,0 +1,123 @@
+'''
+Created on Oct 17, 2026
+
+@author: immanueltrummer
+'''
+import asyncio
+import csv
+
+
+STATS_COLUMNS = [
+    'tokens_read', 'tokens_written', 'cached_tokens', 'seconds', 
+    'overflow', 'cache_hits', 'cache_misses', 'data_tokens', 
+    'invocations', 'recoveries', 'continuations', 
+    'continuation_tokens_read', 'covered_rows', 'listed_pairs', 
+    'failed', 'nr_candidates', 'candidate_ratio', 'phase', 
+    'sample_estimate', 'sample_bound', 'operator', 'resumed']
+
+def collect(stream):
+    """ Collects all statistics and results from a join stream.
+    
+    Args:
+        stream: iterator over (statistics, results) per LLM invocation.
+    
+    Returns:
+        A tuple: (performance statistics, join result).
+    """
+    stats = []
+    results = []
+    for stat, result in stream:
+        stats.append(stat)
+        results += result
+    return stats, results
+
+
+def limit(stream, max_results):
+    """ Stops join stream once enough results have been produced.
+    
+    Args:
+        stream: iterator over (statistics, results) per LLM invocation.
+        max_results: maximal number of results to produce.
+    
+    Returns:
+        generator over (statistics, results) per LLM invocation.
+    """
+    nr_results = 0
+    try:
+        for stat, result in stream:
+            result = result[:max_results-nr_results]
+            nr_results += len(result)
+            yield stat, result
+            if nr_results >= max_results:
+                break
+    finally:
+        stream.close()
+
+
+async def async_stream(stream):
+    """ Wraps join stream into an asynchronous iterator.
+    
+    LLM invocations are executed in a worker thread, so the event loop
+    remains responsive while waiting for results.
+    
+    Args:
+        stream: iterator over (statistics, results) per LLM invocation.
+    
+    Returns:
+        asynchronous generator over (statistics, results).
+    """
+    done = object()
+    try:
+        while True:
+            item = await asyncio.to_thread(next, stream, done)
+            if item is done:
+                break
+            yield item
+    finally:
+        stream.close()
+
+
+def write_stream(
+        stream, stats_path, results_path, stats_columns=STATS_COLUMNS):
+    """ Writes statistics and results to .csv files as they arrive.
+    
+    Rows are flushed after each LLM invocation, so output produced before
+    a crash is preserved. Statistics are written with a fixed set of
+    columns (extended by other keys of the first row), missing values
+    are left empty.
+    
+    Args:
+        stream: iterator over (statistics, results) per LLM invocation.
+        stats_path: path to .csv file for statistics.
+        results_path: path to .csv file for results.
+        stats_columns: columns of the statistics file.
+    
+    Raises:
+        ValueError: if later statistics contain keys without column.
+    """
+    with open(stats_path, 'w', newline='') as stats_file, \
+        open(results_path, 'w', newline='') as results_file:
+        stats_writer = csv.writer(stats_file)
+        results_writer = csv.writer(results_file)
+        results_writer.writerow(['', 'tuple1', 'tuple2'])
+        columns = None
+        nr_stats = 0
+        nr_results = 0
+        for stat, result in stream:
+            if columns is None:
+                columns = list(stats_columns) + [
+                    c for c in stat if c not in stats_columns]
+                stats_writer.writerow([''] + columns)
+            unknown = [c for c in stat if c not in columns]
+            if unknown:
+                raise ValueError(f'No column for statistics {unknown}!')
+            stats_writer.writerow(
+                [nr_stats] + [stat.get(c, '') for c in columns])
+            nr_stats += 1
+            for row in result:
+                results_writer.writerow(
+                    [nr_results, row['tuple1'], row['tuple2']])
+                nr_results += 1
+            
+            stats_file.flush()
+            results_file.flush()
@@ -0,0 +1,95 @@
+'''
+Created on Oct 17, 2026
+
+@author: immanueltrummer
+'''
+import threading
+import tiktoken
+
+
+class TokenCounter():
+    """ Counts tokens of texts, memoizing counts per text.
+    
+    Texts that were not counted before are encoded in batches, using
+    multiple threads. Counters can be shared between threads.
+    """
+    
+    def __init__(self, model, num_threads=8):
+        """ Initializes counter for given model.
+        
+        Args:
+            model: count tokens according to tokenizer of this model.
+            num_threads: number of threads for encoding batches.
+        """
+        self.encoder = tiktoken.encoding_for_model(model)
+        self.num_threads = num_threads
+        self.counts = {}
+        self.lock = threading.Lock()
+    
+    def encode_batch(self, texts):
+        """ Encodes texts and memoizes their token counts.
+        
+        Args:
+            texts: list of texts to encode.
+        
+        Returns:
+            list of token lists.
+        """
+        encoded = self.encoder.encode_batch(
+            texts, num_threads=self.num_threads)
+        with self.lock:
+            for text, tokens in zip(texts, encoded):
+                self.counts[text] = len(tokens)
+        return encoded
+    
+    def count_batch(self, texts):
+        """ Counts tokens of multiple texts.
+        
+        Args:
+            texts: list of texts.
+        
+        Returns:
+            list of token counts.
+        """
+        with self.lock:
+            missing = list(dict.fromkeys(
+                text for text in texts if text not in self.counts))
+        if missing:
+            self.encode_batch(missing)
+        
+        with self.lock:
+            return [self.counts[text] for text in texts]
+    
+    def count(self, text):
+        """ Counts tokens of one text.
+        
+        Args:
+            text: count tokens of this text.
+        
+        Returns:
+            number of tokens.
+        """
+        with self.lock:
+            nr_tokens = self.counts.get(text)
+        if nr_tokens is None:
+            nr_tokens = self.count_batch([text])[0]
+        return nr_tokens
+
+
+counters = {}
+counters_lock = threading.Lock()
+
+
+def get_counter(model):
+    """ Returns token counter shared by all users of the same model.
+    
+    Args:
+        model: name of model whose tokenizer is used.
+    
+    Returns:
+        a token counter.
+    """
+    with counters_lock:
+        if model not in counters:
+            counters[model] = TokenCounter(model)
+        return counters[model]
@@ -4,10 +4,22 @@ Created on Feb 24, 2024
 @author: immanueltrummer
 '''
 import argparse
+import contextlib
+import itertools
 import openai
 import pandas
 import time
 
+from llmjoin.real.backend import get_backend
+from llmjoin.real.block_join import check_self_join
+from llmjoin.real.block_join import mirror
+from llmjoin.real.block_join import token_size
+from llmjoin.real.cache import completion_key
+from llmjoin.real.cache import ResponseCache
+from llmjoin.real.scheduler import ordered_map
+from llmjoin.real.streaming import collect
+from llmjoin.real.streaming import limit
+
 
 def create_prompt(tuple1, tuple2, predicate):
     """ Create prompt to compare two tuples.
@@ -28,54 +40,182 @@ def create_prompt(tuple1, tuple2, predicate):
     return '\n'.join(parts)
 
 
-def tuple_join(client, df1, df2, predicate, model):
-    """ Perform tuple join.
+def join_two_tuples(
+        client, tuple1, tuple2, predicate, model, 
+        limiter=None, cache=None):
+    """ Evaluates join predicate on one pair of tuples.
+    
+    Args:
+        client: OpenAI client or backend.
+        tuple1: tuple from first table.
+        tuple2: tuple from second table.
+        predicate: join predicate.
+        model: name of OpenAI model.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+    
+    Returns:
+        Statistics, join result.
+    """
+    start_s = time.time()
+    prompt = create_prompt(tuple1, tuple2, predicate)
+    print(f'Prompt:\n---\n{prompt}\n---')
+    
+    key = completion_key(model, prompt, 1, 0, None)
+    cached = None if cache is None else cache.lookup(key)
+    cache_hits = 0
+    cache_misses = 0
+    data_tokens = token_size(tuple1) + token_size(tuple2)
+    if cached is None:
+        backend = get_backend(client)
+        max_retries = 3
+        for nr_retries in range(max_retries+1):
+            try:
+                if limiter is not None:
+                    prompt_tokens = token_size(
+                        create_prompt('', '', predicate)) + data_tokens
+                    limiter.acquire(prompt_tokens + 1)
+                response = backend.complete(prompt, model, 1)
+                break
+            except Exception as e:
+                print(f'Exception while calling OpenAI model: {e}')
+                print(f'Used {nr_retries} retries.')
+                if nr_retries < max_retries:
+                    time.sleep(5**nr_retries)
+                else:
+                    raise BaseException('Cannot contact OpenAI!')
+        
+        answer = response['answer']
+        tokens_read = response['tokens_read']
+        tokens_written = response['tokens_written']
+        if cache is not None:
+            cache_misses = 1
+            cache.store(key, {'answer':answer})
+    else:
+        answer = cached['answer']
+        tokens_read = 0
+        tokens_written = 0
+        cache_hits = 1
+    
+    print(f'Answer: {answer}')
+    results = []
+    if answer == 'Yes':
+        results += [{'tuple1':tuple1, 'tuple2':tuple2}]
+    
+    total_s = time.time() - start_s
+    stats = {
+        'tokens_read':tokens_read, 
+        'tokens_written':tokens_written,
+        'seconds':total_s,
+        'cache_hits':cache_hits,
+        'cache_misses':cache_misses,
+        'data_tokens':data_tokens}
+    return stats, results
+
+
+def tuple_join_stream(
+        client, df1, df2, predicate, model, 
+        parallelism=1, limiter=None, cache=None, 
+        max_results=None, token_budget=None, symmetric=False):
+    """ Perform tuple join, producing results for each tuple pair.
+    
+    Tuple pairs are compared concurrently if parallelism exceeds one.
+    Outstanding comparisons are cancelled once the result limit or
+    the token budget is reached (or once the caller stops iterating).
+    Statistics and results are produced in the order of tuple pairs.
+    Symmetric joins compare a table with itself using a symmetric
+    predicate: only pairs of rows i<=j are compared and results for
+    pairs with i<j are mirrored (i.e., added with swapped tuples).
     
     Args:
-        client: OpenAI client.
+        client: OpenAI client or backend.
         df1: first input table.
         df2: second input table.
         predicate: join predicate.
         model: name of OpenAI model.
+        parallelism: maximal number of concurrent LLM invocations.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        max_results: stop after finding that many results (None: no limit).
+        token_budget: stop after reading and writing that many tokens.
+        symmetric: whether to exploit a symmetric predicate in a self-join.
     
     Returns:
-        Tuple: statistics, join result.
+        A generator over (statistics, join result) per tuple pair.
     """
-    nr_pairs = len(df1) * len(df2)
-    pair_counter = 0    
-    results = []
-    stats = []    
+    tuples_1 = list(df1['text'])
+    tuples_2 = list(df2['text'])
+    if symmetric:
+        check_self_join(df1, df2)
+        index_pairs = itertools.combinations_with_replacement(
+            range(len(tuples_1)), 2)
+        nr_pairs = len(df1) * (len(df1) + 1) // 2
+    else:
+        index_pairs = itertools.product(
+            range(len(tuples_1)), range(len(tuples_2)))
+        nr_pairs = len(df1) * len(df2)
+    
+    def join_pair(pair):
+        """ Compares one pair of tuples.
+        
+        Args:
+            pair: tuple with pair counter and the two tuple indexes.
+        
+        Returns:
+            Statistics, join result.
+        """
+        pair_counter, idx_1, idx_2 = pair
+        print(f'\nConsidering tuple pair {pair_counter}/{nr_pairs} ...')
+        stats, results = join_two_tuples(
+            client, tuples_1[idx_1], tuples_2[idx_2], 
+            predicate, model, limiter, cache)
+        if symmetric and idx_1 < idx_2:
+            results = results + mirror(results)
+        return stats, results
+    
+    pairs = (
+        (pair_counter, idx_1, idx_2) 
+        for pair_counter, (idx_1, idx_2) in enumerate(index_pairs, 1))
+    
+    stream = ordered_map(join_pair, pairs, parallelism)
+    if max_results is not None:
+        stream = limit(stream, max_results)
     
-    for _, row1 in df1.iterrows():
-        for _, row2 in df2.iterrows():
-            pair_counter += 1
-            print(f'\nConsidering tuple pair {pair_counter}/{nr_pairs} ...')
+    nr_tokens = 0
+    with contextlib.closing(stream) as pair_results:
+        for stat, result in pair_results:
+            yield stat, result
+            nr_tokens += stat['tokens_read'] + stat['tokens_written']
+            if token_budget is not None and nr_tokens >= token_budget:
+                break
 
-            start_s = time.time()
-            tuple1 = row1['text']
-            tuple2 = row2['text']
-            prompt = create_prompt(tuple1, tuple2, predicate)
-            print(f'Prompt:\n---\n{prompt}\n---')
-            
-            messages = [{'role':'user', 'content':prompt}]
-            response = client.chat.completions.create(
-                messages=messages, model=model, max_tokens=1, temperature=0)
-            
-            answer = response.choices[0].message.content
-            print(f'Answer: {answer}')
-            if answer == 'Yes':
-                results += [{'tuple1':tuple1, 'tuple2':tuple2}]
-            
-            tokens_read = response.usage.prompt_tokens
-            tokens_written = response.usage.completion_tokens
-            total_s = time.time() - start_s
-            
-            stats += [
-                {'tokens_read':tokens_read, 
-                 'tokens_written':tokens_written,
-                 'seconds':total_s}]
+
+def tuple_join(
+        client, df1, df2, predicate, model, 
+        parallelism=1, limiter=None, cache=None, 
+        max_results=None, token_budget=None, symmetric=False):
+    """ Perform tuple join.
     
-    return stats, results
+    Args:
+        client: OpenAI client or backend.
+        df1: first input table.
+        df2: second input table.
+        predicate: join predicate.
+        model: name of OpenAI model.
+        parallelism: maximal number of concurrent LLM invocations.
+        limiter: optional rate limiter for OpenAI requests.
+        cache: optional cache for LLM responses.
+        max_results: stop after finding that many results (None: no limit).
+        token_budget: stop after reading and writing that many tokens.
+        symmetric: whether to exploit a symmetric predicate in a self-join.
+    
+    Returns:
+        Tuple: statistics, join result.
+    """
+    return collect(tuple_join_stream(
+        client, df1, df2, predicate, model, parallelism=parallelism,
+        limiter=limiter, cache=cache, max_results=max_results,
+        token_budget=token_budget, symmetric=symmetric))
 
 
 if __name__ == '__main__':
@@ -88,13 +228,29 @@ if __name__ == '__main__':
     parser.add_argument('predicate', type=str, help='Join predicate')
     parser.add_argument('stats_out', type=str, help='Path for statistics')
     parser.add_argument('result_out', type=str, help='Path for result')
+    parser.add_argument(
+        '--parallelism', type=int, default=1, 
+        help='Maximal number of concurrent requests')
+    parser.add_argument(
+        '--max_results', type=int, help='Stop after that many results')
+    parser.add_argument(
+        '--token_budget', type=int, help='Stop after that many tokens')
+    parser.add_argument('--cache', type=str, help='Path to response cache')
+    parser.add_argument(
+        '--symmetric', action='store_true', 
+        help='Self-join with symmetric predicate')
     args = parser.parse_args()
     
     client = openai.OpenAI(api_key=args.ai_key, timeout=10)
+    cache = None if args.cache is None else ResponseCache(args.cache)
     df1 = pandas.read_csv(args.input1)
     df2 = pandas.read_csv(args.input2)
     
-    statistics, result = tuple_join(client, df1, df2, args.predicate, args.model)
+    statistics, result = tuple_join(
+        client, df1, df2, args.predicate, args.model, 
+        parallelism=args.parallelism, cache=cache, 
+        max_results=args.max_results, token_budget=args.token_budget, 
+        symmetric=args.symmetric)
     statistics = pandas.DataFrame(statistics)
     result = pandas.DataFrame(result)
     statistics.to_csv(args.stats_out)
@@ -0,0 +1,278 @@
+'''
+Created on Oct 17, 2026
+
+@author: immanueltrummer
+'''
+import numpy as np
+
+
+def normalize(embeddings):
+    """ Store embeddings as matrix of unit-length float32 vectors.
+    
+    Args:
+        embeddings: list of embedding vectors.
+    
+    Returns:
+        matrix with one normalized embedding per row.
+    """
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(matrix / norms)
+
+
+def top_k(queries, matrix, k):
+    """ Find most similar rows for each query via one matrix multiply.
+    
+    Args:
+        queries: matrix of normalized query embeddings.
+        matrix: matrix of normalized embeddings to search.
+        k: number of most similar rows to retrieve per query.
+    
+    Returns:
+        matrix of row indexes, matrix of similarities (descending order).
+    """
+    k = min(k, matrix.shape[0])
+    similarities = queries @ matrix.T
+    if k < matrix.shape[0]:
+        indexes = np.argpartition(-similarities, k-1, axis=1)[:, :k]
+    else:
+        indexes = np.tile(np.arange(k), (len(queries), 1))
+    
+    top_similarities = np.take_along_axis(similarities, indexes, axis=1)
+    order = np.argsort(-top_similarities, axis=1, kind='stable')
+    indexes = np.take_along_axis(indexes, order, axis=1)
+    top_similarities = np.take_along_axis(top_similarities, order, axis=1)
+    return indexes, top_similarities
+
+
+class ExactIndex():
+    """ Brute-force index comparing queries with all embeddings. """
+    
+    kind = 'exact'
+    
+    def __init__(self, matrix, fingerprint=''):
+        """ Initializes index.
+        
+        Args:
+            matrix: matrix of normalized embeddings to index.
+            fingerprint: identifies indexed data.
+        """
+        self.matrix = matrix
+        self.fingerprint = fingerprint
+    
+    def search(self, queries, k, nr_probes=None):
+        """ Retrieve most similar embeddings.
+        
+        Args:
+            queries: matrix of normalized query embeddings.
+            k: number of results per query.
+            nr_probes: ignored (exact search compares with all embeddings).
+        
+        Returns:
+            matrix of row indexes, matrix of similarities (descending order).
+        """
+        return top_k(queries, self.matrix, k)
+    
+    def arrays(self):
+        """ Returns arrays describing index (used for persistence). """
+        return {'matrix':self.matrix}
+    
+    @classmethod
+    def from_arrays(cls, arrays, fingerprint):
+        """ Restores index from arrays.
+        
+        Args:
+            arrays: dictionary mapping names to arrays.
+            fingerprint: identifies indexed data.
+        
+        Returns:
+            restored index.
+        """
+        return cls(arrays['matrix'], fingerprint)
+
+
+class IVFIndex():
+    """ Inverted file index using a k-means coarse quantizer.
+    
+    Embeddings are clustered and queries are only compared with
+    embeddings in the most similar clusters. Probing more clusters
+    increases recall at the cost of slower searches.
+    """
+    
+    kind = 'ivf'
+    
+    def __init__(
+            self, matrix, fingerprint='', nr_lists=None,
+            nr_probes=8, nr_iterations=10, seed=0):
+        """ Clusters embeddings and builds inverted lists.
+        
+        Args:
+            matrix: matrix of normalized embeddings to index.
+            fingerprint: identifies indexed data.
+            nr_lists: number of clusters (default: square root of rows).
+            nr_probes: number of clusters searched per query.
+            nr_iterations: number of k-means iterations.
+            seed: seed for choosing initial cluster centers.
+        """
+        self.matrix = matrix
+        self.fingerprint = fingerprint
+        self.nr_probes = nr_probes
+        nr_rows = matrix.shape[0]
+        if nr_lists is None:
+            nr_lists = int(np.sqrt(nr_rows))
+        nr_lists = max(1, min(nr_lists, nr_rows))
+        
+        generator = np.random.default_rng(seed)
+        initial = generator.choice(nr_rows, nr_lists, replace=False)
+        centroids = matrix[initial].copy()
+        for _ in range(nr_iterations):
+            assignments = self._assign(centroids)
+            for list_idx in range(nr_lists):
+                members = matrix[assignments == list_idx]
+                if len(members):
+                    centroids[list_idx] = members.mean(axis=0)
+            centroids = normalize(centroids)
+        
+        self._set_lists(centroids, self._assign(centroids))
+    
+    def _assign(self, centroids, chunk_size=4096):
+        """ Assign each indexed embedding to its most similar centroid.
+        
+        Args:
+            centroids: matrix of cluster centers.
+            chunk_size: number of embeddings processed at once.
+        
+        Returns:
+            array with cluster index per embedding.
+        """
+        assignments = []
+        for start in range(0, self.matrix.shape[0], chunk_size):
+            chunk = self.matrix[start:start+chunk_size]
+            assignments.append(np.argmax(chunk @ centroids.T, axis=1))
+        return np.concatenate(assignments)
+    
+    def _set_lists(self, centroids, assignments):
+        """ Store cluster centers and inverted lists.
+        
+        Args:
+            centroids: matrix of cluster centers.
+            assignments: cluster index per embedding.
+        """
+        self.centroids = centroids
+        self.order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=len(centroids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+    
+    def search(self, queries, k, nr_probes=None):
+        """ Retrieve (approximately) most similar embeddings.
+        
+        Args:
+            queries: matrix of normalized query embeddings.
+            k: number of results per query.
+            nr_probes: number of clusters to search (default: index setting).
+        
+        Returns:
+            matrix of row indexes, matrix of similarities (descending order).
+            Entries are padded with index -1 if too few candidates are found.
+        """
+        nr_probes = self.nr_probes if nr_probes is None else nr_probes
+        nr_probes = max(1, min(nr_probes, len(self.centroids)))
+        k = min(k, self.matrix.shape[0])
+        centroid_similarities = queries @ self.centroids.T
+        probes = np.argpartition(
+            -centroid_similarities, nr_probes-1, axis=1)[:, :nr_probes]
+        
+        indexes = np.full((len(queries), k), -1)
+        similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for query_idx, lists in enumerate(probes):
+            candidates = np.concatenate([
+                self.order[self.offsets[l]:self.offsets[l+1]]
+                for l in lists])
+            if not len(candidates):
+                continue
+            
+            query = queries[query_idx:query_idx+1]
+            local, local_similarities = top_k(
+                query, self.matrix[candidates], k)
+            nr_found = local.shape[1]
+            indexes[query_idx, :nr_found] = candidates[local[0]]
+            similarities[query_idx, :nr_found] = local_similarities[0]
+        
+        return indexes, similarities
+    
+    def arrays(self):
+        """ Returns arrays describing index (used for persistence). """
+        return {
+            'matrix':self.matrix, 'centroids':self.centroids,
+            'order':self.order, 'offsets':self.offsets,
+            'nr_probes':np.array(self.nr_probes)}
+    
+    @classmethod
+    def from_arrays(cls, arrays, fingerprint):
+        """ Restores index from arrays without re-clustering.
+        
+        Args:
+            arrays: dictionary mapping names to arrays.
+            fingerprint: identifies indexed data.
+        
+        Returns:
+            restored index.
+        """
+        index = cls.__new__(cls)
+        index.matrix = arrays['matrix']
+        index.fingerprint = fingerprint
+        index.nr_probes = int(arrays['nr_probes'])
+        index.centroids = arrays['centroids']
+        index.order = arrays['order']
+        index.offsets = arrays['offsets']
+        return index
+
+
+index_types = {index_type.kind:index_type for index_type in [
+    ExactIndex, IVFIndex]}
+
+
+def build_index(kind, matrix, fingerprint='', **parameters):
+    """ Build index of given type.
+    
+    Args:
+        kind: type of index ("exact" or "ivf").
+        matrix: matrix of normalized embeddings to index.
+        fingerprint: identifies indexed data.
+        parameters: parameters for index construction.
+    
+    Returns:
+        new index.
+    """
+    return index_types[kind](matrix, fingerprint, **parameters)
+
+
+def save_index(index, path):
+    """ Write index to disk.
+    
+    Args:
+        index: write this index.
+        path: path of output file (.npz format).
+    """
+    with open(path, 'wb') as file:
+        np.savez(
+            file, kind=np.array(index.kind),
+            fingerprint=np.array(index.fingerprint),
+            **index.arrays())
+
+
+def load_index(path):
+    """ Read index from disk.
+    
+    Args:
+        path: path of index file (.npz format).
+    
+    Returns:
+        loaded index.
+    """
+    with np.load(path) as data:
+        arrays = {name:data[name] for name in data.files}
+    kind = str(arrays.pop('kind'))
+    fingerprint = str(arrays.pop('fingerprint'))
+    return index_types[kind].from_arrays(arrays, fingerprint)
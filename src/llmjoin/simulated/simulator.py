@@ -4,10 +4,15 @@ Created on Feb 23, 2024
 @author: immanueltrummer
 '''
 import argparse
+import concurrent.futures
+import json
 import math
+import os
+import numpy
 import pandas
 
 from llmjoin.common.tuning import optimal_block_size
+from llmjoin.common.tuning import optimal_block_sizes
 
 
 def extract_range(range_str):
@@ -24,6 +29,126 @@ def extract_range(range_str):
     return range(*integers)
 
 
+def parse_number(number_str):
+    """ Parses integer or floating point number.
+    
+    Args:
+        number_str: string representation of number.
+    
+    Returns:
+        an integer if possible, a float otherwise.
+    """
+    try:
+        return int(number_str)
+    except ValueError:
+        return float(number_str)
+
+
+def extract_values(values, number_type=parse_number):
+    """ Extracts values of a simulation parameter.
+    
+    Args:
+        values: range ("start:end:step"), list ("v1,v2,..."), or value.
+        number_type: function converting strings and integers to values.
+    
+    Returns:
+        list of parameter values.
+    """
+    if not isinstance(values, str):
+        return [values]
+    elif ':' in values:
+        return [number_type(v) for v in extract_range(values)]
+    else:
+        return [number_type(v) for v in values.split(',')]
+
+
+def simulate_latency(nr_invocations, total_read, total_written, latency):
+    """ Estimates wall-clock time of LLM invocations.
+    
+    Invocations are assumed to read and write equally many tokens. Up to
+    the concurrency limit, invocations run in parallel waves. Rate limits
+    bound the number of requests and tokens processed per minute.
+    
+    Args:
+        nr_invocations: number of LLM invocations (scalar or array).
+        total_read: number of tokens read over all invocations.
+        total_written: number of tokens written over all invocations.
+        latency: dictionary with latency model parameters (overhead
+            in seconds per call, prefill_rate and generation_rate in
+            tokens per second, concurrency, and optional limits for
+            requests_per_minute and tokens_per_minute).
+    
+    Returns:
+        estimated number of seconds.
+    """
+    nr_calls = numpy.maximum(nr_invocations, 1)
+    call_seconds = latency['overhead'] + \
+        total_read / nr_calls / latency['prefill_rate'] + \
+        total_written / nr_calls / latency['generation_rate']
+    nr_waves = numpy.ceil(nr_invocations / latency['concurrency'])
+    seconds = nr_waves * call_seconds
+    
+    requests_per_minute = latency.get('requests_per_minute')
+    if requests_per_minute is not None:
+        seconds = numpy.maximum(
+            seconds, 60 * nr_invocations / requests_per_minute)
+    tokens_per_minute = latency.get('tokens_per_minute')
+    if tokens_per_minute is not None:
+        seconds = numpy.maximum(
+            seconds, 60 * (total_read + total_written) / tokens_per_minute)
+    return seconds
+
+
+def fit_latency(stats, concurrency=1):
+    """ Fits latency model parameters to statistics of real joins.
+    
+    Only rows without cache hits that read tokens are used. Latency is
+    fit as linear function of invocations (one by default) and tokens
+    read and written.
+    
+    Args:
+        stats: data frame with tokens_read, tokens_written, and seconds.
+        concurrency: number of concurrent invocations in the model.
+    
+    Returns:
+        dictionary with latency model parameters.
+    """
+    calls = stats[stats['tokens_read'] > 0]
+    if 'cache_hits' in calls.columns:
+        calls = calls[calls['cache_hits'].fillna(0) == 0]
+    if len(calls) < 3:
+        raise ValueError('Need at least three invocations to fit latency!')
+    
+    if 'invocations' in calls.columns:
+        nr_invocations = calls['invocations'].fillna(1)
+    else:
+        nr_invocations = numpy.ones(len(calls))
+    features = numpy.column_stack([
+        nr_invocations, calls['tokens_read'], 
+        calls['tokens_written']]).astype(float)
+    coefficients, _, _, _ = numpy.linalg.lstsq(
+        features, calls['seconds'].to_numpy(dtype=float), rcond=None)
+    overhead, read_s, written_s = numpy.maximum(coefficients, 1e-9)
+    return {
+        'overhead':float(overhead), 
+        'prefill_rate':float(1 / read_s),
+        'generation_rate':float(1 / written_s),
+        'concurrency':concurrency}
+
+
+def load_profile(path):
+    """ Loads simulation parameters fitted to real runs.
+    
+    Args:
+        path: path to .json file with parameter profile.
+    
+    Returns:
+        dictionary mapping parameter names to values.
+    """
+    with open(path) as file:
+        return json.load(file)
+
+
 def simulate_tuple_join(r1, r2, s1, s2, s3, g, p):
     """ Simulates a tuple join.
     
@@ -139,77 +264,424 @@ def simulate_adaptive_join(r1, r2, s1, s2, s3, sigma, estimate, g, p, t):
         f'adaptive_written':total_written}
 
 
-def run_benchmark(
-        r1, r2, s1, s2, s3, sigma_pm, 
-        g, t, p_tuple, p_block, out_file):
-    """ Runs benchmark and writes result to .csv file.
+def simulate_incremental_join(
+        r1, r2, s1, s2, s3, sigma, estimate, g, p, t, 
+        growth=2, max_rounds=64):
+    """ Simulate adaptive join that only splits overflowing block pairs.
+    
+    This models adaptive_join_stream: results of block pairs without
+    overflows are kept. For overflowing pairs, entries of the first
+    block covered by the truncated answer are kept as well and the
+    remaining entries are joined again, using block sizes based on
+    the selectivity observed in the truncated answer (multiplied by
+    growth). Block pairs of equal size are simulated together.
+    
+    Args:
+        r1: number of rows in first table.
+        r2: number of rows in second table.
+        s1: size of tuples in first table.
+        s2: size of tuples in second table.
+        s3: size of output entries.
+        sigma: actual selectivity of join predicate.
+        estimate: initial estimate for join selectivity (may be too low).
+        g: relative cost of written tokens.
+        p: size of static part of prompt template.
+        t: maximal number of tokens read and generated per LLM invocation.
+        growth: factor by which estimates are increased after overflows.
+        max_rounds: maximal number of rounds (error if exceeded).
+    
+    Returns:
+        A dictionary with simulation results.
+    """
+    def split(n1, n2, split_estimate, overflowed=False):
+        """ Splits a pair of blocks (as split_blocks in adaptive join).
+        
+        Args:
+            n1: number of rows from first table.
+            n2: number of rows from second table.
+            split_estimate: selectivity estimate for block pair.
+            overflowed: whether the blocks overflowed (split at least in half).
+        
+        Returns:
+            dictionary mapping sizes of resulting block pairs to counts.
+        """
+        b1, b2 = optimal_block_size(s1, s2, s3, t, p, split_estimate)
+        b1 = max(1, min(b1, n1))
+        b2 = max(1, min(b2, n2))
+        if overflowed and b1 == n1 and b2 == n2:
+            b1 = max(1, b1 // 2)
+            b2 = max(1, b2 // 2)
+        
+        sizes_1 = [(b1, n1 // b1), (n1 % b1, 1)]
+        sizes_2 = [(b2, n2 // b2), (n2 % b2, 1)]
+        return {
+            (c1, c2):count_1*count_2 
+            for c1, count_1 in sizes_1 for c2, count_2 in sizes_2 
+            if c1 and c2 and count_1 and count_2}
+    
+    pending = {
+        sizes + (estimate,):count 
+        for sizes, count in split(r1, r2, estimate).items()}
+    nr_invocations = 0
+    total_read = 0
+    total_written = 0
+    overflow = False
+    for _ in range(max_rounds):
+        overflowed = {}
+        for (b1, b2, pair_estimate), nr_pairs in pending.items():
+            prompt_size = p + b1*s1 + b2*s2
+            output_size = b1*b2*sigma*s3
+            nr_invocations += nr_pairs
+            total_read += prompt_size * nr_pairs
+            if prompt_size + output_size <= t:
+                total_written += output_size * nr_pairs
+                continue
+            
+            written = max(0, t - prompt_size)
+            total_written += written * nr_pairs
+            if b1 * b2 == 1:
+                overflow = True
+                continue
+            
+            listed = written / s3
+            observed = listed / (b1*b2)
+            new_estimate = growth * max(observed, pair_estimate)
+            covered = min(b1 - 1, math.floor(listed / (b2*sigma)))
+            sub_pairs = split(
+                b1 - covered, b2, new_estimate, overflowed=True)
+            for (c1, c2), count in sub_pairs.items():
+                key = (c1, c2, new_estimate)
+                overflowed[key] = overflowed.get(key, 0) + nr_pairs * count
+        
+        pending = overflowed
+        if not pending:
+            break
+    else:
+        raise ValueError(f'Overflows remain after {max_rounds} rounds!')
+    
+    return {
+        'incremental_invocations':nr_invocations, 
+        'incremental_cost':total_read + total_written * g,
+        'incremental_read':total_read, 
+        'incremental_written':total_written,
+        'incremental_overflow':overflow}
+
+
+def simulate_block_grid(
+        r1, r2, s1, s2, s3, sigma, estimate, g, p, t, latency=None):
+    """ Simulate block-nested loops join for arrays of parameters.
     
     Args:
-        r1: range of sizes for first table (format: "start:end:step").
-        r2: size of second table.
-        s1: range of tuple sizes for first table.
-        s2: size of tuple in second table.
+        r1: array with number of tuples in first table.
+        r2: array with number of tuples in second table.
+        s1: array with size of each tuple in first table.
+        s2: array with size of each tuple in second table.
+        s3: array with size of each output tuple.
+        sigma: array with selectivity of join predicate.
+        estimate: array with selectivity estimates used for block sizes.
+        g: array with relative cost of writing tuples.
+        p: array with size of static part of prompt.
+        t: array with maximal number of tokens per model invocation.
+        latency: optional latency model (see simulate_latency).
+    
+    Returns:
+        A dictionary mapping result names (without prefix) to arrays.
+    """
+    b1, b2 = optimal_block_sizes(s1, s2, s3, t, p, estimate)
+    prompt_size = p+b1*s1+b2*s2
+    output_size = b1*b2*sigma*s3
+    
+    # Block sizes are irrelevant after overflows (may be zero)
+    total_tokens = prompt_size + output_size
+    overflow = total_tokens > t
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        nr_pairs = numpy.ceil(r1/b1) * numpy.ceil(r2/b2)
+    nr_invocations = numpy.where(overflow, 1, nr_pairs).astype(numpy.int64)
+    total_read = numpy.where(
+        overflow, prompt_size, prompt_size * nr_invocations)
+    total_written = numpy.where(
+        overflow, output_size - (total_tokens - t), 
+        output_size * nr_invocations)
+    total_cost = total_read + total_written * g
+    results = {
+        'block_invocations':nr_invocations, 
+        'block_cost':total_cost,
+        'block_read':total_read, 
+        'block_written':total_written,
+        'block_overflow':overflow}
+    if latency is not None:
+        results['block_seconds'] = simulate_latency(
+            nr_invocations, total_read, total_written, latency)
+    return results
+
+
+def simulate_adaptive_grid(
+        r1, r2, s1, s2, s3, sigma, estimate, g, p, t, 
+        latency=None, max_rounds=64):
+    """ Simulate adaptive join algorithm for arrays of parameters.
+    
+    Each round simulates a block join for all settings that overflowed
+    in the previous round, using four times higher estimates. Rounds
+    are executed one after the other, so their latencies add up.
+    
+    Args:
+        r1: array with number of rows in first table.
+        r2: array with number of rows in second table.
+        s1: array with size of tuples in first table.
+        s2: array with size of tuples in second table.
+        s3: array with size of output entries.
+        sigma: array with actual selectivity of join predicate.
+        estimate: array with initial estimates for join selectivity.
+        g: array with relative cost of written tokens.
+        p: array with size of static part of prompt template.
+        t: array with maximal number of tokens per LLM invocation.
+        latency: optional latency model (see simulate_latency).
+        max_rounds: maximal number of rounds (error if exceeded).
+    
+    Returns:
+        A dictionary mapping result names to arrays.
+    """
+    params = [
+        a.ravel() for a in numpy.broadcast_arrays(
+            r1, r2, s1, s2, s3, sigma, estimate, g, p, t)]
+    shape = numpy.broadcast_shapes(*[numpy.shape(a) for a in (
+        r1, r2, s1, s2, s3, sigma, estimate, g, p, t)])
+    params[6] = params[6].astype(float)
+    keys = ['invocations', 'cost', 'read', 'written']
+    if latency is not None:
+        keys += ['seconds']
+    totals = None
+    active = numpy.arange(params[0].size)
+    for _ in range(max_rounds):
+        result = simulate_block_grid(
+            *[a[active] for a in params], latency=latency)
+        if totals is None:
+            totals = {k:result[f'block_{k}'] for k in keys}
+        else:
+            for k, total in totals.items():
+                total[active] += result[f'block_{k}']
+        
+        overflow = result['block_overflow']
+        active = active[overflow]
+        params[6][active] *= 4
+        if not active.size:
+            break
+    else:
+        raise ValueError(f'Overflows remain after {max_rounds} rounds!')
+    
+    return {
+        f'adaptive_{k}':total.reshape(shape) 
+        for k, total in totals.items()}
+
+
+def simulate_grid(
+        r1, r2, s1, s2, s3, sigma, g, t, p_tuple, p_block, latency=None):
+    """ Simulates all join algorithms for a grid of parameter settings.
+    
+    Parameters are arrays (or scalars) that are broadcast against each
+    other. Results contain the same columns as rows of run_benchmark.
+    Given a latency model, estimated seconds are added per algorithm.
+    
+    Args:
+        r1: number of rows in first table.
+        r2: number of rows in second table.
+        s1: size of tuples in first table.
+        s2: size of tuples in second table.
         s3: size of join result tuple.
-        sigma_pm: pro mille selectivity range.
+        sigma: selectivity of join predicate.
         g: relative cost per output token.
         t: maximal number of tokens per LLM invocation.
         p_tuple: size of static prompt part for tuple join.
         p_block: size of static prompt part for block join.
-        out_file: name of result output file. 
-    """
-    r1_range = extract_range(r1)
-    s1_range = extract_range(s1)
-    sigma_pm_range = extract_range(sigma_pm)
-    
-    results = []
-    for r1 in r1_range:
-        for s1 in s1_range:
-            for sigma_pm in sigma_pm_range:
-                sigma = 0.001 * sigma_pm
-                result = {
-                    'r1':r1, 'r2':r2, 
-                    's1':s1, 's2':s2, 's3':s3, 
-                    'sigma':sigma, 'g':g, 't':t,
-                    'p_tuple':p_tuple, 'p_block':p_block}
-                result = result | simulate_tuple_join(
-                    r1, r2, s1, s2, s3, 
-                    g, p_tuple)
-                result = result | simulate_block_join(
-                    r1, r2, s1, s2, s3, 
-                    sigma, sigma, 
-                    g, p_block, t, 'informed')
-                result = result | simulate_block_join(
-                    r1, r2, s1, s2, s3, 
-                    sigma, 1, 
-                    g, p_block, t, 'conservative')
-                result = result | simulate_adaptive_join(
-                    r1, r2, s1, s2, s3, 
-                    sigma, sigma/100.0, 
-                    g, p_block, t)
-                
-                results += [result]
-    
-    df = pandas.DataFrame(results)
-    df.to_csv(out_file, index=False)
+        latency: optional latency model (see simulate_latency).
+    
+    Returns:
+        A dictionary mapping column names to flat arrays.
+    """
+    r1, r2, s1, s2, s3, sigma, g, t, p_tuple, p_block = [
+        a.ravel() for a in numpy.broadcast_arrays(
+            r1, r2, s1, s2, s3, sigma, g, t, p_tuple, p_block)]
+    results = {
+        'r1':r1, 'r2':r2, 
+        's1':s1, 's2':s2, 's3':s3, 
+        'sigma':sigma, 'g':g, 't':t,
+        'p_tuple':p_tuple, 'p_block':p_block}
+    results |= simulate_tuple_join(
+        r1, r2, s1, s2, s3, 
+        g, p_tuple)
+    if latency is not None:
+        results['tuple_seconds'] = simulate_latency(
+            results['tuple_invocations'], results['tuple_read'], 
+            results['tuple_written'], latency)
+    for prefix, estimate in [
+        ('informed', sigma), ('conservative', numpy.ones_like(sigma))]:
+        block_results = simulate_block_grid(
+            r1, r2, s1, s2, s3, 
+            sigma, estimate, 
+            g, p_block, t, latency)
+        results |= {
+            f'{prefix}_{k}':v for k, v in block_results.items()}
+    results |= simulate_adaptive_grid(
+        r1, r2, s1, s2, s3, 
+        sigma, sigma/100.0, 
+        g, p_block, t, latency)
+    return results
+
+
+def simulate_chunk(grid, start, end, latency=None):
+    """ Simulates join algorithms for a consecutive part of a grid.
+    
+    Args:
+        grid: list of value lists, one per run_benchmark parameter.
+        start: index of first grid point (in row-major order).
+        end: index after last grid point.
+        latency: optional latency model (see simulate_latency).
+    
+    Returns:
+        data frame with one row per grid point.
+    """
+    shape = [len(values) for values in grid]
+    indexes = numpy.unravel_index(numpy.arange(start, end), shape)
+    r1, r2, s1, s2, s3, sigma_pm, g, t, p_tuple, p_block = [
+        numpy.asarray(values)[idx] for values, idx in zip(grid, indexes)]
+    results = simulate_grid(
+        r1, r2, s1, s2, s3, 0.001 * sigma_pm, 
+        g, t, p_tuple, p_block, latency)
+    return pandas.DataFrame(results)
+
+
+def write_frame(df, out_path, out_format):
+    """ Writes data frame to file.
+    
+    Args:
+        df: data frame to write.
+        out_path: path of output file.
+        out_format: output format ("csv" or "parquet").
+    """
+    if out_format == 'parquet':
+        df.to_parquet(out_path, index=False)
+    elif out_format == 'csv':
+        df.to_csv(out_path, index=False)
+    else:
+        raise ValueError(f'Unknown output format: {out_format}')
+
+
+def run_benchmark(
+        r1, r2, s1, s2, s3, sigma_pm, 
+        g, t, p_tuple, p_block, out_file, 
+        chunk_size=None, workers=1, out_format='csv', latency=None):
+    """ Runs benchmark and writes result to .csv file.
+    
+    Each parameter is a range ("start:end:step"), a comma-separated
+    list of values, or a single value. All combinations of parameter
+    values are simulated. If a chunk size is given, the grid is split
+    into chunks that are simulated by parallel worker processes and
+    the output file is a directory with one file per chunk.
+    
+    Args:
+        r1: sizes of first table.
+        r2: sizes of second table.
+        s1: tuple sizes for first table.
+        s2: tuple sizes for second table.
+        s3: sizes of join result tuples.
+        sigma_pm: pro mille selectivities.
+        g: relative costs per output token.
+        t: maximal numbers of tokens per LLM invocation.
+        p_tuple: sizes of static prompt part for tuple join.
+        p_block: sizes of static prompt part for block join.
+        out_file: name of result output file (or directory for chunks).
+        chunk_size: number of grid points per chunk (None: no chunks).
+        workers: number of worker processes for simulating chunks.
+        out_format: output format ("csv" or "parquet").
+        latency: optional latency model for estimating seconds.
+    """
+    grid = [extract_values(values) for values in [
+        r1, r2, s1, s2, s3, sigma_pm]]
+    grid += [extract_values(g, float)]
+    grid += [extract_values(values) for values in [t, p_tuple, p_block]]
+    nr_points = math.prod(len(values) for values in grid)
+    if chunk_size is None:
+        write_frame(
+            simulate_chunk(grid, 0, nr_points, latency), 
+            out_file, out_format)
+        return
+    
+    os.makedirs(out_file, exist_ok=True)
+    starts = range(0, nr_points, chunk_size)
+    ends = [min(start + chunk_size, nr_points) for start in starts]
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        chunks = executor.map(
+            simulate_chunk, [grid] * len(starts), starts, ends, 
+            [latency] * len(starts))
+        for chunk_idx, df in enumerate(chunks):
+            out_path = os.path.join(
+                out_file, f'part-{chunk_idx:05d}.{out_format}')
+            write_frame(df, out_path, out_format)
 
 
 if __name__ == '__main__':
     
-    parser = argparse.ArgumentParser()
-    parser.add_argument('r1', type=str, help='Size range of the first table')
-    parser.add_argument('r2', type=int, help='Size of second table')
-    parser.add_argument('s1', type=str, help='Size range for first tuple size')
-    parser.add_argument('s2', type=int, help='Size of tuples in second table')
-    parser.add_argument('s3', type=int, help='Size of output tuples')
-    parser.add_argument('sigma_pm', type=str, help='Selectivity range pro mille')
-    parser.add_argument('g', type=float, help='Relative cost of output tokens')
-    parser.add_argument('t', type=int, help='Maximal #tokens per invocation')
-    parser.add_argument('p_tuple', type=int, help='Static size for tuple join')
-    parser.add_argument('p_block', type=int, help='Static size for block join')
+    parser = argparse.ArgumentParser(
+        description='Parameters are ranges ("start:end:step"), '
+        'comma-separated lists, or single values.')
+    parser.add_argument('r1', type=str, help='Sizes of the first table')
+    parser.add_argument('r2', type=str, help='Sizes of second table')
+    parser.add_argument('s1', type=str, help='Tuple sizes in first table')
+    parser.add_argument('s2', type=str, help='Tuple sizes in second table')
+    parser.add_argument('s3', type=str, help='Sizes of output tuples')
+    parser.add_argument('sigma_pm', type=str, help='Selectivities pro mille')
+    parser.add_argument('g', type=str, help='Relative costs of output tokens')
+    parser.add_argument('t', type=str, help='Maximal #tokens per invocation')
+    parser.add_argument('p_tuple', type=str, help='Static size for tuple join')
+    parser.add_argument('p_block', type=str, help='Static size for block join')
     parser.add_argument('out_file', type=str, help='Name of result file')
+    parser.add_argument(
+        '--chunk_size', type=int, help='Grid points per output chunk')
+    parser.add_argument(
+        '--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument(
+        '--format', type=str, default='csv', choices=['csv', 'parquet'],
+        help='Output format')
+    parser.add_argument(
+        '--latency', action='store_true', help='Estimate wall-clock time')
+    parser.add_argument(
+        '--overhead', type=float, default=0.5, help='Seconds per call')
+    parser.add_argument(
+        '--prefill_rate', type=float, default=5000, 
+        help='Tokens read per second')
+    parser.add_argument(
+        '--generation_rate', type=float, default=50, 
+        help='Tokens generated per second')
+    parser.add_argument(
+        '--concurrency', type=int, default=1, 
+        help='Maximal number of concurrent calls')
+    parser.add_argument(
+        '--rpm', type=float, help='Maximal number of requests per minute')
+    parser.add_argument(
+        '--tpm', type=float, help='Maximal number of tokens per minute')
+    parser.add_argument(
+        '--profile', type=str, 
+        help='Parameter profile (overrides s3, t, prompt sizes, latency)')
     args = parser.parse_args()
     
+    latency = None
+    if args.latency:
+        latency = {
+            'overhead':args.overhead, 
+            'prefill_rate':args.prefill_rate,
+            'generation_rate':args.generation_rate,
+            'concurrency':args.concurrency,
+            'requests_per_minute':args.rpm,
+            'tokens_per_minute':args.tpm}
+    if args.profile is not None:
+        profile = load_profile(args.profile)
+        for name in ['s3', 't', 'p_tuple', 'p_block']:
+            if name in profile:
+                setattr(args, name, str(profile[name]))
+        latency = profile.get('latency', latency)
+    
     run_benchmark(
         args.r1, args.r2, args.s1, args.s2, args.s3, 
         args.sigma_pm, args.g, args.t, 
-        args.p_tuple, args.p_block, args.out_file)
\ No newline at end of file
+        args.p_tuple, args.p_block, args.out_file, 
+        args.chunk_size, args.workers, args.format, latency)